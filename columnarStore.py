@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+# parquet output of webScraper, imageDownloader and dataPostProcess, written next to their csv files
+# the csv files flatten the sets with g_delimiter, here they are native list<string> columns and the columns with a
+# few distinct values (category, color, status) are dictionary encoded, a job reads only the columns it needs
+# e.g. pyarrow.parquet.read_table('MANGO/items.parquet', columns=['uniqueId', 'category', 'imageUrls'])
+# pyarrow is optional, the scripts only need it with --parquet
+
+from collections import OrderedDict
+import os
+import os.path
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+
+g_list_columns = set(['imageUrls', 'priceArray', 'outfitIds', 'outfitUrls'])
+g_dictionary_columns = set(['category', 'color', 'status', 'imageDownloadStatus'])
+g_compression = 'zstd'
+g_batch_size = 10000 # rows converted to arrow at a time, memory stays flat whatever the table size
+
+
+def isAvailable():
+	return pyarrow is not None
+
+def getParquetPath(csvPath):
+	return os.path.splitext(csvPath)[0] + '.parquet'
+
+# parquet file of a csv when it was written after the csv, None when it is missing or stale
+# (a run without --parquet rewrote the csv since)
+def getFreshParquetPath(csvPath):
+	path = getParquetPath(csvPath)
+	if not os.path.exists(path):
+		return None
+	if os.path.exists(csvPath) and os.path.getmtime(path) < os.path.getmtime(csvPath):
+		return None
+	return path
+
+# the match- columns of the transactions have the type of the item column
+def getBaseColumn(column):
+	return column[len('match-'):] if column.startswith('match-') else column
+
+def getColumnType(column):
+	column = getBaseColumn(column)
+	if column in g_list_columns:
+		return pyarrow.list_(pyarrow.string())
+	if column in g_dictionary_columns:
+		return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+	return pyarrow.string()
+
+def getSchema(columns):
+	return pyarrow.schema([(column, getColumnType(column)) for column in columns])
+
+# sets are written sorted so the same items give the same file, strings joined with the delimiter are split back
+def toListCell(value, delimiter):
+	if value is None:
+		return None
+	if isinstance(value, str):
+		return value.split(delimiter)
+	return sorted(value)
+
+def toCell(value):
+	if value is None:
+		return None
+	return str(value)
+
+def toBatch(schema, columns, rows, delimiter):
+	arrays = []
+	for i, column in enumerate(columns):
+		if getBaseColumn(column) in g_list_columns:
+			values = [toListCell(row[i], delimiter) for row in rows]
+		else:
+			values = [toCell(row[i]) for row in rows]
+		arrays.append(pyarrow.array(values, type=schema.field(i).type))
+	return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+# writes the rows (lists in the order of columns) to a parquet file, next to the target then renamed
+# a list column takes a set, a list or a string joined with delimiter
+def writeRowsToParquet(path, columns, rows, delimiter='|'):
+	if pyarrow is None:
+		raise ImportError('the parquet output needs pyarrow')
+	schema = getSchema(columns)
+	writer = pyarrow.parquet.ParquetWriter(path + '.tmp', schema, compression=g_compression)
+	try:
+		batch = []
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= g_batch_size:
+				writer.write_batch(toBatch(schema, columns, batch, delimiter))
+				batch = []
+		if batch:
+			writer.write_batch(toBatch(schema, columns, batch, delimiter))
+	finally:
+		writer.close()
+	os.replace(path + '.tmp', path)
+
+# writes key -> aa dictionaries like writeDictToCSV(), the key is the first column
+# @items = iterable of (key, aa), e.g. g_items.items()
+def writeDictToParquet(path, columns, items, delimiter='|'):
+	writeRowsToParquet(path, columns, ([key] + [aa.get(column) for column in columns[1:]] for key, aa in items), delimiter)
+
+# rows of a parquet file as ordered dictionaries in the column order of the file, like the csv.DictReader rows
+# the list columns are lists, the nulls are '' like the empty csv cells
+# @columns = only read these columns, all of them by default
+def readParquetRows(path, columns=None):
+	if pyarrow is None:
+		raise ImportError('reading parquet needs pyarrow')
+	parquetFile = pyarrow.parquet.ParquetFile(path)
+	names = columns or parquetFile.schema_arrow.names
+	for batch in parquetFile.iter_batches(batch_size=g_batch_size, columns=names):
+		values = [batch.column(column).to_pylist() for column in names]
+		for row in zip(*values):
+			yield OrderedDict([(column, '' if value is None else value) for column, value in zip(names, row)])
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+
+# offline end to end benchmark of webScraper
+# serves a synthetic mango like site from a local http server : catalog pages whose products are lazy loaded on
+# scroll (#navColumns4, #productCatalog) and product pages with the elements read by extractFeatures()
+# (div.referenciaProducto.row-fluid, the Form:SVFichaProducto:panelFicha panel, the outfit section, the image div)
+# then crawls it with headless chrome and reports pages/sec, the latency of every crawl stage and the peak memory
+# every crawl runs in its own process and temporary working directory, so the module state and the csv files start empty
+#
+# usage : python3 crawlBenchmark.py --products 100 1000 5000 --workers 2
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import argparse
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+g_categories = ['shirts-tops', 'dresses', 'jeans', 'coats', 'skirts']
+g_first_product_id = 81000000
+g_outfit_size = 2 # outfit links per product page
+g_images_per_product = 4
+g_catalog_batch_size = 24 # products added to the catalog by every lazy load
+g_stages = ['page', 'driver_get', 'http_get', 'wait', 'extract', 'link_harvest', 'catalog_scroll', 'save_session', 'driver_start']
+# 1x1 transparent gif served for every image
+g_pixel = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+
+def productCategory(productId):
+	return g_categories[productId % len(g_categories)]
+
+def productUrl(base, productId):
+	return '%s/us/women/%s/synthetic-item_%d.html' % (base, productCategory(productId), productId)
+
+def catalogUrl(base, category):
+	return '%s/us/women/%s' % (base, category)
+
+def renderNavigation(base):
+	links = ['<a href="%s">%s</a>' % (catalogUrl(base, category), category) for category in g_categories]
+	return '<div id="nav">%s</div>' % ''.join(links)
+
+# product page with the same element paths as the live site, see g_extract_features_script in webScraper.py
+def renderProductPage(base, productId, products):
+	index = productId - g_first_product_id
+	outfit = [g_first_product_id + (index + i) % products for i in range(1, g_outfit_size + 1)]
+	outfitLinks = ''.join(['<a href="%s">outfit</a>' % productUrl(base, outfitId) for outfitId in outfit])
+	images = ''.join(['<img src="%s/images/%d_%d.jpg">' % (base, productId, i) for i in range(g_images_per_product)])
+	price = 10 + index % 90
+	return '''<html><head><title>synthetic item %(id)d</title></head><body>
+%(nav)s
+<div id="mainDivBody"><div><div></div><div></div><div></div><div></div><div><div></div><div>%(images)s</div></div></div></div>
+<div id="Form:SVFichaProducto:panelFicha">
+<div><div><div><div><h1>Synthetic item %(id)d</h1></div><div class="referenciaProducto row-fluid">REF. %(id)d</div></div><div><div>$%(price)d.99<br>$%(sale)d.99</div></div></div></div>
+<div>Color: Color %(color)d</div>
+<div></div><div></div><div></div><div></div>
+<div>
+Synthetic description of item %(id)d
+100%% cotton
+Machine wash
+</div>
+</div>
+<div class="look completa_look accordion-body in collapse span12">%(outfit)s</div>
+</body></html>''' % {'id' : productId, 'nav' : renderNavigation(base), 'images' : images, 'price' : price, 'sale' : price // 2,
+		'color' : index % 7, 'outfit' : outfitLinks}
+
+# catalog page, the products are appended g_catalog_batch_size at a time when the page is scrolled to the bottom
+# @latency = ms before a batch shows up, like the xhr of the live site
+def renderCatalogPage(base, category, products, latency):
+	productIds = [productId for productId in range(g_first_product_id, g_first_product_id + products) if productCategory(productId) == category]
+	hrefs = [productUrl(base, productId) for productId in productIds]
+	return '''<html><head><title>%(category)s</title></head><body>
+%(nav)s
+<button id="navColumns4" onclick="document.getElementById('productCatalog').className = 'columns4';">4</button>
+<div id="productCatalog"></div>
+<script>
+var hrefs = %(hrefs)s;
+var next = 0, loading = false;
+function loadBatch() {
+	loading = true;
+	setTimeout(function () {
+		var catalog = document.getElementById('productCatalog');
+		for (var end = Math.min(next + %(batch)d, hrefs.length); next < end; next++) {
+			var tile = document.createElement('div');
+			tile.style.height = '400px';
+			var a = document.createElement('a');
+			a.href = hrefs[next];
+			a.textContent = 'item';
+			tile.appendChild(a);
+			catalog.appendChild(tile);
+		}
+		loading = false;
+	}, %(latency)d);
+}
+window.addEventListener('scroll', function () {
+	if (!loading && next < hrefs.length && window.innerHeight + window.scrollY >= document.body.scrollHeight - 800) {
+		loadBatch();
+	}
+});
+loadBatch();
+</script>
+</body></html>''' % {'category' : category, 'nav' : renderNavigation(base), 'hrefs' : json.dumps(hrefs), 'batch' : g_catalog_batch_size, 'latency' : latency}
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		server = self.server
+		if server.latency:
+			time.sleep(server.latency / 1000.0)
+		parts = self.path.split('?')[0].strip('/').split('/')
+		if len(parts) == 2 and parts[0] == 'images':
+			self.reply(g_pixel, 'image/gif')
+		elif len(parts) == 3 and parts[:2] == ['us', 'women'] and parts[2] in g_categories:
+			self.reply(renderCatalogPage(server.base, parts[2], server.products, server.latency).encode('utf-8'), 'text/html; charset=utf-8')
+		elif len(parts) == 4 and parts[:2] == ['us', 'women'] and parts[3].endswith('.html') and '_' in parts[3]:
+			productId = int(parts[3][parts[3].rfind('_') + 1:-len('.html')])
+			if g_first_product_id <= productId < g_first_product_id + server.products:
+				self.reply(renderProductPage(server.base, productId, server.products).encode('utf-8'), 'text/html; charset=utf-8')
+			else:
+				self.send_error(404)
+		else:
+			self.send_error(404)
+
+	def reply(self, body, contentType):
+		self.send_response(200)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+# serves the synthetic site from a daemon thread, returns the server, server.base is the url of the site
+# @products = number of product pages, spread over g_categories
+# @latency = ms added to every response
+def startFixtureServer(products, latency=0, port=0):
+	server = ThreadingHTTPServer(('127.0.0.1', port), FixtureHandler)
+	server.daemon_threads = True
+	server.products = products
+	server.latency = latency
+	server.base = 'http://127.0.0.1:%d' % server.server_address[1]
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+# max rss of this process and all its children (chromedriver, chrome) sampled every interval seconds, in MB
+def samplePeakMemory(webScraper, peak, stopped, interval=0.5):
+	while not stopped.wait(interval):
+		peak[0] = max(peak[0], webScraper.getProcessTreeRss(os.getpid()))
+
+# crawls the fixture site in a fresh working directory, runs in the child process
+# returns the result dictionary printed as json for the parent
+def runCrawl(config):
+	workDir = tempfile.mkdtemp(prefix='crawlBenchmark-')
+	for directory in ['MANGO', 'session-logs', 'FAILEDPAGES']:
+		os.makedirs(os.path.join(workDir, directory))
+	#webScraper opens its log file in the working directory when it is imported
+	os.chdir(workDir)
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import webScraper
+
+	base = config['base']
+	webScraper.g_logger.setLevel(config['logLevel'])
+	webScraper.g_domain = base.split('://')[1] + '/us/women'
+	webScraper.g_blacklist = ['javascript:window.open']
+	webScraper.g_workers = config['workers']
+	webScraper.g_http_fast_path = config['httpFastPath']
+	webScraper.g_block_resources = config['blockResources']
+	webScraper.g_rate_limit = config['rateLimit']
+	webScraper.g_frontier_backend = config['frontier']
+	webScraper.g_metrics_summary_interval = 0
+	seed = catalogUrl(base, g_categories[0])
+	webScraper.g_new_urls = {seed : {'priority' : 0}}
+	webScraper.g_new_urls_heapq = [(0, seed)]
+
+	peak = [0]
+	stopped = threading.Event()
+	threading.Thread(target=samplePeakMemory, args=(webScraper, peak, stopped), daemon=True).start()
+	start = time.time()
+	webScraper.main()
+	webScraper.saveSessionOutput(True)
+	elapsed = time.time() - start
+	stopped.set()
+	webScraper.closeFrontier()
+
+	metrics = webScraper.g_metrics
+	stages = {}
+	for stage in g_stages:
+		histogram = metrics.getHistogram('stage_latency', stage=stage)
+		if histogram:
+			stages[stage] = histogram
+	return {'pages' : metrics.getCounterTotal('pages'), 'items' : len(webScraper.g_items), 'urls' : len(webScraper.g_processed_urls),
+		'elapsed' : elapsed, 'pagesPerSecond' : metrics.getCounterTotal('pages') / elapsed, 'failures' : metrics.getCounterTotal('page_failures'),
+		'peakRss' : max(peak[0], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0), 'stages' : stages, 'workDir' : workDir}
+
+# starts the fixture site and crawls it in a child process, returns the result of runCrawl()
+def benchmark(products, args):
+	server = startFixtureServer(products, args.latency)
+	try:
+		config = {'base' : server.base, 'workers' : args.workers, 'httpFastPath' : not args.no_http_fast_path, 'blockResources' : not args.no_block_resources,
+			'rateLimit' : args.rate_limit, 'frontier' : args.frontier, 'logLevel' : args.log_level}
+		child = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', json.dumps(config)], stdout=subprocess.PIPE, check=True)
+		result = json.loads(child.stdout.decode('utf-8').strip().split('\n')[-1])
+	finally:
+		server.shutdown()
+	result['products'] = products
+	return result
+
+def printResult(result):
+	print('%d products : %d pages (%d items, %d failures) in %.1f s, %.2f pages/s, peak rss %d MB' % (result['products'], result['pages'],
+		result['items'], result['failures'], result['elapsed'], result['pagesPerSecond'], result['peakRss']))
+	for stage in g_stages:
+		if stage in result['stages']:
+			h = result['stages'][stage]
+			print('\t%-15s %6d calls, avg %7.1f ms, p50 %6d ms, p95 %6d ms, max %7.1f ms' % (stage, h['count'], h['avg'], h['p50'], h['p95'], h['max']))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='crawl a synthetic mango like site served locally and report the crawl performance')
+	parser.add_argument('--products', type=int, nargs='+', default=[100, 1000], help='number of product pages of the site, one crawl per value')
+	parser.add_argument('--workers', type=int, default=1, help='number of concurrent webdriver sessions')
+	parser.add_argument('--latency', type=int, default=0, help='ms added to every response of the site')
+	parser.add_argument('--no-http-fast-path', action='store_true', help='always render the pages in the browser')
+	parser.add_argument('--no-block-resources', action='store_true', help='load every resource of the pages')
+	parser.add_argument('--rate-limit', action='store_true', help='pace the requests like against the live site')
+	parser.add_argument('--frontier', choices=['memory', 'sqlite'], default='memory', help='where the url pipelines are kept')
+	parser.add_argument('--log-level', default='WARNING', help='log level of the crawl')
+	parser.add_argument('--json', action='store_true', help='print the results as json')
+	parser.add_argument('--run', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.run:
+		print(json.dumps(runCrawl(json.loads(args.run))))
+		sys.exit(0)
+
+	results = []
+	for products in args.products:
+		result = benchmark(products, args)
+		results.append(result)
+		if not args.json:
+			printResult(result)
+	if args.json:
+		print(json.dumps(results, indent=1))
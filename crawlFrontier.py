@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+# disk backed crawl frontier for webScraper
+# the url pipelines (new, processing, processed and the product aliases) live in one sqlite table, webScraper
+# keeps using them through dictionary like views so g_new_urls[url], url in g_processed_urls etc. keep working
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+# url -> bit positions in the bloom filter, k positions derived from one blake2b digest
+def bloomPositions(url, bits, hashes):
+	digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+	h1 = int.from_bytes(digest[:8], 'little')
+	h2 = int.from_bytes(digest[8:], 'little') | 1
+	return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+# set of all the urls ever seen, a negative answer is definite so unknown urls never hit the disk
+class BloomFilter(object):
+	def __init__(self, bits, hashes):
+		self.bits = bits
+		self.hashes = hashes
+		self.array = bytearray((bits + 7) // 8)
+
+	def add(self, url):
+		for position in bloomPositions(url, self.bits, self.hashes):
+			self.array[position >> 3] |= 1 << (position & 7)
+
+	def __contains__(self, url):
+		for position in bloomPositions(url, self.bits, self.hashes):
+			if not self.array[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+
+# dictionary view of the urls of one status, e.g. frontier.pipeline('new') is g_new_urls
+class UrlPipeline(MutableMapping):
+	def __init__(self, frontier, status):
+		self.frontier = frontier
+		self.status = status
+
+	def __getitem__(self, url):
+		entry = self.frontier.lookup(url)
+		if entry is None or entry[0] != self.status:
+			raise KeyError(url)
+		return entry[1]
+
+	def __contains__(self, url):
+		entry = self.frontier.lookup(url)
+		return entry is not None and entry[0] == self.status
+
+	# moves the url to this pipeline, whatever its previous status
+	def __setitem__(self, url, aa):
+		self.frontier.store(url, self.status, aa)
+
+	# only removes the url if it is still in this pipeline, so 'move then delete from the old pipeline' is safe
+	def __delitem__(self, url):
+		if not self.frontier.remove(url, self.status):
+			raise KeyError(url)
+
+	def __iter__(self):
+		return self.frontier.iterUrls(self.status)
+
+	def __len__(self):
+		return self.frontier.count(self.status)
+
+
+# sqlite frontier in WAL mode
+# @path = database file, an existing file is reopened as is so a restart does not reload the csv
+# @cacheSize = max number of urls kept in the in memory hot cache
+# @bloomBits, @bloomHashes = size of the bloom filter used for the membership checks of unknown urls
+# @setKeys = keys of the url dictionaries that hold sets, json only knows lists
+class SqliteFrontier(object):
+	def __init__(self, path, cacheSize=100000, bloomBits=1 << 27, bloomHashes=7, setKeys=('outfitUrls',)):
+		self.lock = threading.RLock()
+		self.cacheSize = cacheSize
+		self.setKeys = setKeys
+		self.cache = OrderedDict() # url -> (status, aa)
+		self.bloom = BloomFilter(bloomBits, bloomHashes)
+		self.sequence = 0
+
+		self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, status TEXT NOT NULL, priority INTEGER NOT NULL, sequence INTEGER NOT NULL, data TEXT NOT NULL)')
+		# the priority pop reads the first row of this index
+		self.db.execute('CREATE INDEX IF NOT EXISTS urls_status_priority ON urls (status, priority, sequence)')
+		# product id -> canonical url of the product, the other urls of a product are stored with the 'alias' status
+		self.db.execute('CREATE TABLE IF NOT EXISTS products (productId TEXT PRIMARY KEY, url TEXT NOT NULL)')
+
+		row = self.db.execute('SELECT MAX(sequence) FROM urls').fetchone()
+		if row[0] is not None:
+			self.sequence = row[0]
+		for (url,) in self.db.execute('SELECT url FROM urls'):
+			self.bloom.add(url)
+
+		self.pipelines = {}
+		for status in ['new', 'processing', 'processed', 'alias']:
+			self.pipelines[status] = UrlPipeline(self, status)
+
+	def pipeline(self, status):
+		return self.pipelines[status]
+
+	def encode(self, aa):
+		return json.dumps(aa, default=list)
+
+	def decode(self, data):
+		aa = json.loads(data)
+		for key in self.setKeys:
+			if key in aa:
+				aa[key] = set(aa[key])
+		return aa
+
+	def cachePut(self, url, entry):
+		self.cache[url] = entry
+		self.cache.move_to_end(url)
+		while len(self.cache) > self.cacheSize:
+			self.cache.popitem(False)
+
+	# returns (status, aa) or None when the url was never seen
+	def lookup(self, url):
+		with self.lock:
+			if url in self.cache:
+				self.cache.move_to_end(url)
+				return self.cache[url]
+			if url not in self.bloom:
+				return None
+			row = self.db.execute('SELECT status, data FROM urls WHERE url = ?', (url,)).fetchone()
+			if row is None:
+				return None
+			entry = (row[0], self.decode(row[1]))
+			self.cachePut(url, entry)
+			return entry
+
+	def isKnown(self, url):
+		return self.lookup(url) is not None
+
+	def nextSequence(self):
+		self.sequence += 1
+		return self.sequence
+
+	def store(self, url, status, aa):
+		with self.lock:
+			self.db.execute('INSERT INTO urls (url, status, priority, sequence, data) VALUES (?, ?, ?, ?, ?) '
+				'ON CONFLICT(url) DO UPDATE SET status = excluded.status, priority = excluded.priority, data = excluded.data',
+				(url, status, int(aa.get('priority', 0)), self.nextSequence(), self.encode(aa)))
+			self.bloom.add(url)
+			self.cachePut(url, (status, aa))
+
+	# batched insert of new urls, one transaction for the whole list
+	# @urls = list of (url, aa), the urls must not be known yet
+	def addNewUrls(self, urls):
+		with self.lock:
+			rows = []
+			for url, aa in urls:
+				rows.append((url, 'new', int(aa.get('priority', 0)), self.nextSequence(), self.encode(aa)))
+			self.db.execute('BEGIN')
+			try:
+				self.db.executemany('INSERT OR IGNORE INTO urls (url, status, priority, sequence, data) VALUES (?, ?, ?, ?, ?)', rows)
+				self.db.execute('COMMIT')
+			except:
+				self.db.execute('ROLLBACK')
+				raise
+			for url, aa in urls:
+				self.bloom.add(url)
+				self.cachePut(url, ('new', aa))
+
+	def getProductUrl(self, productId):
+		with self.lock:
+			row = self.db.execute('SELECT url FROM products WHERE productId = ?', (productId,)).fetchone()
+			if row is None:
+				return None
+			return row[0]
+
+	def setProductUrl(self, productId, url):
+		with self.lock:
+			self.db.execute('INSERT OR IGNORE INTO products (productId, url) VALUES (?, ?)', (productId, url))
+
+	def remove(self, url, status):
+		with self.lock:
+			cursor = self.db.execute('DELETE FROM urls WHERE url = ? AND status = ?', (url, status))
+			if cursor.rowcount == 0:
+				return False
+			self.cache.pop(url, None)
+			return True
+
+	# url with the lowest priority in the new pipeline (first inserted among equals), '' when there is none
+	# the url stays in the new pipeline, the caller moves it to processing
+	def peekNewUrl(self):
+		with self.lock:
+			row = self.db.execute("SELECT url FROM urls WHERE status = 'new' ORDER BY priority, sequence LIMIT 1").fetchone()
+			if row is None:
+				return ''
+			return row[0]
+
+	# urls left in processing by a crashed session go back to the new pipeline
+	def requeueProcessing(self):
+		with self.lock:
+			urls = [row[0] for row in self.db.execute("SELECT url FROM urls WHERE status = 'processing'")]
+			for url in urls:
+				entry = self.lookup(url)
+				aa = entry[1]
+				aa['status'] = 'new'
+				self.store(url, 'new', aa)
+			return len(urls)
+
+	def iterUrls(self, status):
+		with self.lock:
+			cursor = self.db.execute('SELECT url FROM urls WHERE status = ? ORDER BY sequence', (status,))
+		while True:
+			with self.lock:
+				rows = cursor.fetchmany(1000)
+			if not rows:
+				return
+			for row in rows:
+				yield row[0]
+
+	# urls of the pipeline whose next visit (lastVisit + revisitInterval) is before the deadline, filtered in sql
+	# so only the due urls are read, the missing or empty fields count as 0 like in the csv
+	def listDueUrls(self, status, deadline):
+		with self.lock:
+			return [row[0] for row in self.db.execute("SELECT url FROM urls WHERE status = ? AND "
+				"IFNULL(CAST(json_extract(data, '$.lastVisit') AS REAL), 0) + IFNULL(CAST(json_extract(data, '$.revisitInterval') AS REAL), 0) <= ? "
+				"ORDER BY sequence", (status, deadline))]
+
+	def count(self, status):
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM urls WHERE status = ?', (status,)).fetchone()[0]
+
+	def close(self):
+		with self.lock:
+			self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+			self.db.close()
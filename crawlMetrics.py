@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+# crawl instrumentation for webScraper
+# counters, gauges and latency histograms of the crawl stages, exposed as prometheus text (/metrics) and json
+# (/metrics.json) by a local http server and logged as one summary line every few seconds
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import threading
+import time
+
+
+# upper bounds of the latency histogram buckets in ms, the last bucket is +Inf
+g_latency_buckets = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+
+def formatLabels(labels):
+	if not labels:
+		return ''
+	return '{' + ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]) + '}'
+
+
+class Histogram(object):
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+
+	def observe(self, value):
+		index = len(self.buckets)
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				index = i
+				break
+		self.counts[index] += 1
+		self.count += 1
+		self.sum += value
+		self.max = max(self.max, value)
+
+	# upper bound of the bucket holding the quantile, the max for the +Inf bucket
+	def quantile(self, q):
+		if self.count == 0:
+			return 0.0
+		rank = q * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			seen += count
+			if seen >= rank and count:
+				return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+		return self.max
+
+	def toDict(self):
+		return {'count' : self.count, 'sum' : self.sum, 'avg' : self.sum / self.count if self.count else 0.0, 'max' : self.max,
+			'p50' : self.quantile(0.5), 'p95' : self.quantile(0.95), 'p99' : self.quantile(0.99)}
+
+
+# thread safe registry of the metrics of one crawl session
+# counters and histograms are keyed by name and labels, e.g. increment('pages', type='product')
+# gauges are callables read when the metrics are exported, e.g. the size of the frontier pipelines
+class Metrics(object):
+	def __init__(self, prefix='webscraper', buckets=g_latency_buckets):
+		self.prefix = prefix
+		self.buckets = buckets
+		self.lock = threading.Lock()
+		self.startTime = time.time()
+		self.counters = {}
+		self.histograms = {}
+		self.gauges = {}
+		# pages counter and time of the previous summary, for the pages/sec of the last interval
+		self.lastSummary = (0, self.startTime)
+
+	def increment(self, name, amount=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + amount
+
+	def observe(self, name, value, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			if key not in self.histograms:
+				self.histograms[key] = Histogram(self.buckets)
+			self.histograms[key].observe(value)
+
+	def setGauge(self, name, function):
+		self.gauges[name] = function
+
+	# latency of one crawl stage in ms, observed even when the stage raises
+	@contextmanager
+	def timer(self, stage):
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.observe('stage_latency', (time.time() - start) * 1000, stage=stage)
+
+	def getCounter(self, name, **labels):
+		with self.lock:
+			return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+	# sum of a counter over all its labels
+	def getCounterTotal(self, name):
+		with self.lock:
+			return sum([value for key, value in self.counters.items() if key[0] == name])
+
+	# label values of a counter, e.g. getLabelValues('pages', 'type') -> ['catalog', 'http', 'product']
+	def getLabelValues(self, name, label):
+		with self.lock:
+			return sorted(set([dict(key[1]).get(label) for key in self.counters if key[0] == name]) - set([None]))
+
+	def getHistogram(self, name, **labels):
+		with self.lock:
+			histogram = self.histograms.get((name, tuple(sorted(labels.items()))))
+			if histogram is None:
+				return None
+			return histogram.toDict()
+
+	def readGauges(self):
+		values = {}
+		for name, function in sorted(self.gauges.items()):
+			try:
+				values[name] = function()
+			except Exception:
+				values[name] = None
+		return values
+
+	def uptime(self):
+		return time.time() - self.startTime
+
+	def pagesPerSecond(self):
+		return self.getCounterTotal('pages') / max(self.uptime(), 1e-6)
+
+	def snapshot(self):
+		with self.lock:
+			counters = [{'name' : name, 'labels' : dict(labels), 'value' : value} for (name, labels), value in sorted(self.counters.items())]
+			histograms = [dict(histogram.toDict(), name=name, labels=dict(labels)) for (name, labels), histogram in sorted(self.histograms.items())]
+		return {'uptime' : self.uptime(), 'pagesPerSecond' : self.pagesPerSecond(), 'counters' : counters,
+			'gauges' : self.readGauges(), 'histograms' : histograms}
+
+	def toPrometheus(self):
+		lines = []
+		prefix = self.prefix + '_'
+		lines.append('# TYPE %suptime_seconds gauge' % prefix)
+		lines.append('%suptime_seconds %f' % (prefix, self.uptime()))
+		lines.append('# TYPE %spages_per_second gauge' % prefix)
+		lines.append('%spages_per_second %f' % (prefix, self.pagesPerSecond()))
+		for name, value in self.readGauges().items():
+			if value is not None:
+				lines.append('# TYPE %s%s gauge' % (prefix, name))
+				lines.append('%s%s %s' % (prefix, name, value))
+
+		with self.lock:
+			typed = set()
+			for (name, labels), value in sorted(self.counters.items()):
+				if name not in typed:
+					typed.add(name)
+					lines.append('# TYPE %s%s_total counter' % (prefix, name))
+				lines.append('%s%s_total%s %s' % (prefix, name, formatLabels(labels), value))
+
+			for (name, labels), histogram in sorted(self.histograms.items()):
+				metric = '%s%s_milliseconds' % (prefix, name)
+				if name not in typed:
+					typed.add(name)
+					lines.append('# TYPE %s histogram' % metric)
+				cumulative = 0
+				for bound, count in zip(self.buckets + ['+Inf'], histogram.counts):
+					cumulative += count
+					lines.append('%s_bucket%s %d' % (metric, formatLabels(labels + (('le', bound),)), cumulative))
+				lines.append('%s_sum%s %f' % (metric, formatLabels(labels), histogram.sum))
+				lines.append('%s_count%s %d' % (metric, formatLabels(labels), histogram.count))
+		return '\n'.join(lines) + '\n'
+
+	# one line : throughput since the start and since the previous summary, the gauges, the counters
+	# and the average/p95 latency of every stage
+	def summary(self):
+		pages = self.getCounterTotal('pages')
+		now = time.time()
+		lastPages, lastTime = self.lastSummary
+		self.lastSummary = (pages, now)
+		parts = ['%d pages, %.2f pages/s (%.2f last %ds)' % (pages, self.pagesPerSecond(), (pages - lastPages) / max(now - lastTime, 1e-6), now - lastTime)]
+		parts.extend(['%s %s' % (name, value) for name, value in self.readGauges().items()])
+		with self.lock:
+			totals = {}
+			for (name, labels), value in self.counters.items():
+				totals[name] = totals.get(name, 0) + value
+			stages = [(dict(labels).get('stage'), histogram.toDict()) for (name, labels), histogram in sorted(self.histograms.items()) if name == 'stage_latency']
+		parts.extend(['%s %d' % (name, value) for name, value in sorted(totals.items()) if name != 'pages'])
+		parts.extend(['%s avg %d ms p95 %d ms' % (stage, h['avg'], h['p95']) for stage, h in stages])
+		return ', '.join(parts)
+
+
+def createHandler(metrics):
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path == '/metrics':
+				body = metrics.toPrometheus().encode('utf-8')
+				contentType = 'text/plain; version=0.0.4'
+			elif self.path == '/metrics.json':
+				body = json.dumps(metrics.snapshot(), indent=1).encode('utf-8')
+				contentType = 'application/json'
+			else:
+				self.send_error(404)
+				return
+			self.send_response(200)
+			self.send_header('Content-Type', contentType)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		#the scrapes would flood the crawl logs
+		def log_message(self, format, *args):
+			pass
+
+	return MetricsHandler
+
+# serves /metrics and /metrics.json from a daemon thread, returns the server (server.shutdown() stops it)
+# @port = 0 picks a free port, server.server_address has the one in use
+def startMetricsServer(metrics, port, host='127.0.0.1'):
+	server = ThreadingHTTPServer((host, port), createHandler(metrics))
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+# logs metrics.summary() every interval seconds from a daemon thread, returns the event that stops it
+# @log = logging function, e.g. logger.info
+def startSummaryLogger(metrics, interval, log):
+	stopped = threading.Event()
+
+	def run():
+		while not stopped.wait(interval):
+			log('metrics : %s', metrics.summary())
+
+	threading.Thread(target=run, daemon=True).start()
+	return stopped
@@ -10,15 +10,27 @@ import time
 import logging
 import platform
 import traceback
+import argparse
+import zlib
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+import columnarStore
+import itemStore
 
 g_delimiter = '|'
 # IMPORTANT! these columns are the final table columns, edit here when you increase or decrease the columns
 g_items_column = ['uniqueId', 'itemName', 'category', 'priceArray', 'color', 'description', 'imageUrls', 'url', 'outfitIds']
-# global dictionary of all fashion products like - top, bottom, dress, accessories etc.
-# key = uniqueId (which is unique within a website), value = other metadata related to the item
-g_items = {}
 g_categories = {}
 g_items_csv_file_path = '/items_in.csv'
+# --workers > 1 splits items_in.csv in byte ranges on row boundaries, parsed and enriched on a process pool
+g_workers = 1
+g_chunks_per_worker = 4 # smaller chunks even out the load of the workers
+g_min_chunk_size = 1024 * 1024 # bytes
+g_set_columns = ['imageUrls', 'priceArray', 'outfitIds', 'outfitUrls']
+# items_in.parquet is read instead of items_in.csv when it is up to date, items_out and transactions are also
+# written as parquet, override with --parquet
+g_parquet_output = False
 g_logger = logging.getLogger('datapostprocess')
 g_logger.setLevel(logging.DEBUG)
 #create console handler with same log level
@@ -34,6 +46,20 @@ g_logger.addHandler(ch)
 
 #g_feature_column = ['composition_1','composition_2','composition_3','composition_4','composition_5','composition_percent_1','composition_percent_2','composition_percent_3','composition_percent_4','composition_percent_5','fabric','sleeve','neckline','lapels','cuffs','detail','design','texture','finish','clasp','closure','button','strap','lining','effect','seams','applique', 'collar'] 
 g_feature_column = ['fabric','sleeve','neckline','lapels','cuffs','detail','design','texture','finish','clasp','closure','button','strap','effect','seams','collar'] 
+# one alternation compiled once, the first feature word found in a description fragment names the column of the fragment
+# it is searched in the lower cased fragment, a case sensitive search of lower case words is ~3x faster than re.IGNORECASE
+g_feature_regex = re.compile('|'.join([re.escape(feature.lower()) for feature in g_feature_column]))
+# composition columns, off by default, override with --composition
+# 'Composition: 52% cotton,48% polyester' -> composition_1 = cotton, composition_percent_1 = 52, composition_2 = polyester ...
+g_extract_composition = False
+g_composition_materials = 5
+g_composition_column = ['composition_%d' % (i + 1) for i in range(g_composition_materials)] + ['composition_percent_%d' % (i + 1) for i in range(g_composition_materials)]
+g_composition_fragment_regex = re.compile('composition', re.IGNORECASE)
+g_composition_regex = re.compile('(\d+(?:[.,]\d+)?)\s*%\s*([^\d,;%|]+)')
+# global dictionary of all fashion products like - top, bottom, dress, accessories etc.
+# key = uniqueId (which is unique within a website), value = other metadata related to the item
+# compact dictionary like store, the description features repeat from item to item so they are interned too
+g_items = itemStore.ItemStore(internColumns=itemStore.g_intern_columns + g_feature_column + g_composition_column)
 #imageUrls   url outfitIds
 g_categories = set([
 'shirts-tops',
@@ -84,81 +110,188 @@ g_transaction_column = ['uniqueId','itemName','category','priceArray','color','d
 
 g_transaction_column_match = ['match-uniqueId','match-itemName','match-category','match-priceArray','match-color','match-description','match-imageUrls','match-url','match-outfitIds','match-fabric','match-sleeve','match-neckline','match-lapels','match-cuffs','match-detail','match-design','match-texture','match-finish','match-clasp','match-closure','match-button','match-strap','match-effect','match-seams','match-collar']
 
-#return a list of transactions 
+# transaction export modes, override with --dedup-pairs and --sample
+# appendOutfitId() links both ways, with g_dedup_pairs an outfit pair is exported once instead of as (a,b) and (b,a)
+g_dedup_pairs = False
+# fraction of the pairs exported, the decision is a hash of the pair so a sample is the same from run to run
+g_sample_rate = 1.0
+
+# True when the pair belongs to the sample, (a,b) and (b,a) get the same answer
+def isSampledPair(item, matchItem):
+    if g_sample_rate >= 1.0:
+        return True
+    pair = g_delimiter.join(sorted([item, matchItem]))
+    return zlib.crc32(pair.encode('utf-8')) < g_sample_rate * 0x100000000
+
+#generates the header then one transaction (item row + match item row) per outfit pair
+#the row of an item is serialized once and reused for all its pairs
 def expandOutfitIds():
-    transactions = []
     fullColumns = list(g_transaction_column)
     fullColumns.extend(g_transaction_column_match)
-    transactions.append(fullColumns)
+    yield fullColumns
+
+    rows = {}
+    def getRow(item):
+        if item not in rows:
+            rows[item] = dictionaryToList(convertAAtoRow(item, g_items[item]), g_transaction_column)
+        return rows[item]
+
+    #the item store decodes a new set on every read, each item's outfit ids are decoded once
+    outfits = {}
+    def getOutfitIds(item):
+        if item not in outfits:
+            outfits[item] = g_items[item]['outfitIds']
+        return outfits[item]
 
     for item in g_items:
-        for matchItem in g_items[item]['outfitIds']:
+        for matchItem in getOutfitIds(item):
             if matchItem in g_items:
-                aa = convertAAtoRow(item, g_items[item])
-                transaction = dictionaryToList(aa, g_transaction_column)
-
-                aa = convertAAtoRow(matchItem, g_items[matchItem])
-                transaction.extend(dictionaryToList(aa, g_transaction_column))
-                #print('++++++++', transaction)
-                transactions.append(transaction)
-    
-    return transactions
+                #the reverse pair is exported from the smaller uniqueId
+                if g_dedup_pairs and item > matchItem and item in getOutfitIds(matchItem):
+                    continue
+                if not isSampledPair(item, matchItem):
+                    continue
+                yield getRow(item) + getRow(matchItem)
 
 #maintain the sequence
 def dictionaryToList(dictionary, columnNameList, prefix=''):
-    fullDict = {}
-    print ("DEBUG %s " % str (dictionary))
-    print ('+++++++', columnNameList)
-    for columnName in columnNameList:
-        if columnName in dictionary:
-            fullDict[columnName] = prefix + dictionary[columnName]
-        else:
-            fullDict[columnName] = 'null'
-
-    print('++++++', list(fullDict.values()))
-    return list(fullDict.values())
+    return [prefix + dictionary[columnName] if columnName in dictionary else 'null' for columnName in columnNameList]
 
 
-def splitDescription(descriptionBlob, pattern):
+# feature column -> description fragment, the last fragment of a feature wins
+# @regex = compiled alternation of the lower case feature words, g_feature_regex by default
+def splitDescription(descriptionBlob, regex=g_feature_regex):
     aa = {}
-    if descriptionBlob and pattern:
-        descriptionArray = re.split('\|', descriptionBlob)
-        for item in descriptionArray:
-            #pattern = 'fabric|sleeve|neckline|lapels|cuffs|detail|design|texture|finish|clasp|closure|button|strap|effect|seams|collar' 
-            match = re.findall(pattern,item,re.IGNORECASE)
+    if descriptionBlob:
+        for item in descriptionBlob.split(g_delimiter):
+            match = regex.search(item.lower())
             if match:
-                aa[match[0].lower()] = item
+                aa[match.group(0)] = item
 
     return aa
 
+# composition_<n> and composition_percent_<n> of the materials of the composition fragments
+# (or of the whole description when no fragment is labelled composition)
+def extractComposition(descriptionBlob):
+    aa = {}
+    if descriptionBlob:
+        fragments = [item for item in descriptionBlob.split(g_delimiter) if g_composition_fragment_regex.search(item)]
+        pairs = g_composition_regex.findall(g_delimiter.join(fragments) if fragments else descriptionBlob)
+        for i, (percent, material) in enumerate(pairs[:g_composition_materials]):
+            aa['composition_%d' % (i + 1)] = material.strip().lower()
+            aa['composition_percent_%d' % (i + 1)] = percent.replace(',', '.')
+    return aa
+
+# enriches the loaded items in one pass over all the descriptions
+def extractAllFeatures(items):
+    for aa in items.values():
+        aa.update(splitDescription(aa.get('description')))
+        if g_extract_composition:
+            aa.update(extractComposition(aa.get('description')))
+
 def readCSVToDict(csvFile):
     if os.path.exists(csvFile):
         try:
             with open(csvFile) as csvfile:
                 reader = csv.DictReader(csvfile)
                 for row in reader:
-                    convertRowToAA(row)
+                    # DictReader rows are plain dicts since python 3.8, popitem(False) needs an OrderedDict
+                    convertRowToAA(OrderedDict(row))
 
         except IOError:
             g_logger.error("I/O error({0}): {1}".format(errno, strerror))
 
-def convertRowToAA(row):
+# splits the csv after its header in about chunkCount byte ranges ending on a row terminator
+# returns (fieldnames, [(start, end), ...]) or None when the rows are not terminated by '\r\n'
+# the csv module ends the rows with '\r\n' and keeps a newline inside a quoted field as '\n', so '\r\n' is a row boundary
+def findChunkBoundaries(csvFile, chunkCount):
+    fileSize = os.path.getsize(csvFile)
+    with open(csvFile, 'rb') as fp:
+        header = fp.readline()
+        if not header.endswith(b'\r\n'):
+            return None
+        fieldnames = next(csv.reader(io.TextIOWrapper(io.BytesIO(header))))
+        chunkSize = max(g_min_chunk_size, (fileSize - len(header)) // max(chunkCount, 1) + 1)
+        boundaries = [len(header)]
+        while boundaries[-1] < fileSize:
+            fp.seek(min(boundaries[-1] + chunkSize, fileSize) - 1)
+            #read up to the end of the row that contains the target offset
+            tail = b''
+            while True:
+                block = fp.read(64 * 1024)
+                tail += block
+                position = tail.find(b'\r\n')
+                if position != -1 or not block:
+                    break
+            end = fileSize if position == -1 else fp.tell() - len(tail) + position + 2
+            boundaries.append(end)
+    return (fieldnames, list(zip(boundaries[:-1], boundaries[1:])))
+
+# runs in the worker processes : parses the rows of the byte range [start, end) and extracts their features
+# returns the (uniqueId, aa) of the rows in file order, the sets are sent as the lists they were built from
+# because a pickled set can come back in another iteration order, which would change the order of the csv cells
+def parseChunk(csvFile, start, end, fieldnames, withComposition):
+    global g_extract_composition
+    g_extract_composition = withComposition
+    with open(csvFile, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+
+    items = []
+    #same newline and encoding handling as open(csvFile) in readCSVToDict()
+    for row in csv.DictReader(io.TextIOWrapper(io.BytesIO(data)), fieldnames=fieldnames):
+        item = parseRow(OrderedDict(row))
+        if item is not None:
+            items.append(item)
+            for key in g_set_columns:
+                if key in item[1]:
+                    item[1][key] = row[key].split(g_delimiter)
+    extractAllFeatures(dict(items))
+    return items
+
+# multi process version of readCSVToDict() + extractAllFeatures(), the chunks are merged in file order
+# so g_items ends up exactly as with one process
+def readCSVToDictParallel(csvFile):
+    if not os.path.exists(csvFile):
+        return
+    chunks = findChunkBoundaries(csvFile, g_workers * g_chunks_per_worker)
+    if chunks is None:
+        g_logger.warning('readCSVToDictParallel() %s rows do not end with \\r\\n, parsing it in one process', csvFile)
+        readCSVToDict(csvFile)
+        extractAllFeatures(g_items)
+        return
+
+    fieldnames, ranges = chunks
+    g_logger.debug('readCSVToDictParallel() %d chunks on %d workers', len(ranges), g_workers)
+    with ProcessPoolExecutor(max_workers=g_workers) as executor:
+        results = executor.map(parseChunk, [csvFile] * len(ranges), [start for start, end in ranges], [end for start, end in ranges],
+            [fieldnames] * len(ranges), [g_extract_composition] * len(ranges))
+        for items in results:
+            for uniqueId, aa in items:
+                for key in g_set_columns:
+                    if key in aa:
+                        aa[key] = set(aa[key])
+                g_items[uniqueId] = aa
+
+# returns (uniqueId, aa) of an item row of a kept category, None otherwise
+def parseRow(row):
     if row:
         # ecah row is an ordered dictionary
         # row.popitem(False) will give out the items in FIFO manner, 
         # which means first item to be popped will be either 'url' or 'uniqueId'
         key, value = row.popitem(False)
         aa = sanitizeCSVRow(row) #row now contains rest of the items except the url/uniqueid
-        pattern = g_delimiter.join(g_feature_column) 
 
         if aa['category'] in g_categories and key == 'uniqueId':
-            descriptionAA = splitDescription(aa['description'], pattern)
+            return (value, aa)
+    return None
 
-            if descriptionAA:
-                aa.update(descriptionAA)
-            #print ('++++++++++', aa)
-            uniqueId = value
-            g_items[uniqueId] = aa 
+def convertRowToAA(row):
+    #the description features are extracted by extractAllFeatures() once all the rows are loaded
+    item = parseRow(row)
+    if item is not None:
+        uniqueId, aa = item
+        g_items[uniqueId] = aa 
 
 #CSV writer flattens all data to string, this function will change it back as per the key type
 #TODO: move to a better data marshalling scheme
@@ -166,8 +299,9 @@ def sanitizeCSVRow(row):
     aa = {} 
     while row:
         key, value = row.popitem(False)
-        if key == 'imageUrls' or key == 'priceArray' or key == 'outfitIds' or key == 'outfitUrls':
-            aa[key] = set(value.split(g_delimiter))
+        if key in g_set_columns:
+            #the parquet rows already hold lists
+            aa[key] = set(value) if isinstance(value, list) else set(value.split(g_delimiter))
         else:
             aa[key] = value
     return aa
@@ -198,6 +332,7 @@ def writeDictToCSV(csvFile, csvColumns, dictionary):
     except IOError:
         g_logger.error("I/O error({0}): {1}".format(errno, strerror))    
 
+# @listInput = list or generator of rows, a generator is written as it goes
 def writeListToCSV(csvFile, listInput):
     try:
         with open(csvFile, 'w') as csvfile:
@@ -212,12 +347,39 @@ def main():
     itemCSVPath = currentPath + g_items_csv_file_path
     print ("DEBUG", itemCSVPath)
     #load the csv as dictionary	
-    readCSVToDict(itemCSVPath)
+    parquetPath = columnarStore.getFreshParquetPath(itemCSVPath) if g_parquet_output else None
+    if parquetPath is not None:
+        for row in columnarStore.readParquetRows(parquetPath):
+            convertRowToAA(row)
+        extractAllFeatures(g_items)
+    elif g_workers > 1:
+        readCSVToDictParallel(itemCSVPath)
+    else:
+        readCSVToDict(itemCSVPath)
+        extractAllFeatures(g_items)
 
 #main function
 #python lets you use the same source file as a reusable module or standalone
 #when python runs it as standalone, it sends __name__ with value "__main__"
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='extract the description features of the items and export the outfit transactions')
+    parser.add_argument('--composition', action='store_true', help='add the composition and composition percent columns')
+    parser.add_argument('--dedup-pairs', action='store_true', help='export every outfit pair once instead of in both directions')
+    parser.add_argument('--sample', type=float, default=g_sample_rate, help='fraction of the outfit pairs exported')
+    parser.add_argument('--workers', type=int, default=g_workers, help='processes parsing items_in.csv')
+    parser.add_argument('--parquet', action='store_true', help='read items_in.parquet when it is up to date and also write the output as parquet')
+    args = parser.parse_args()
+    g_workers = args.workers
+    g_parquet_output = args.parquet
+    if g_parquet_output and not columnarStore.isAvailable():
+        parser.error('--parquet needs pyarrow')
+    g_extract_composition = args.composition
+    g_dedup_pairs = args.dedup_pairs
+    g_sample_rate = args.sample
+    if g_extract_composition:
+        g_feature_column = g_feature_column + g_composition_column
+        g_transaction_column = g_transaction_column + g_composition_column
+        g_transaction_column_match = g_transaction_column_match + ['match-' + column for column in g_composition_column]
     try:
         main()
         g_logger.debug('Program finished, items in dictionary %d', len(g_items))
@@ -227,6 +389,10 @@ if __name__ == "__main__":
         
         transactions = expandOutfitIds()
         writeListToCSV(os.getcwd() + '/transactions.csv', transactions)
+        if g_parquet_output:
+            columnarStore.writeDictToParquet(os.getcwd() + '/items_out.parquet', g_items_column, g_items.items(), g_delimiter)
+            transactions = expandOutfitIds()
+            columnarStore.writeRowsToParquet(os.getcwd() + '/transactions.parquet', next(transactions), transactions, g_delimiter)
 
     except:
         #keyboard interrupt
@@ -1,21 +1,51 @@
 import click
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import contextmanager
+from collections import OrderedDict
+from urllib.parse import urlparse
+from urllib.parse import urlunparse
 import threading
 import csv
+import hashlib
+import json
+import shutil
 import os
 import os.path
 import time
 import logging
 import traceback
 
+import columnarStore
+import itemStore
+
 g_delimiter = '|'
 # IMPORTANT! these columns are the final table columns, edit here when you increase or decrease the columns
 g_items_column = ['uniqueId', 'itemName', 'category', 'priceArray', 'color', 'description', 'imageUrls', 'url', 'outfitIds', 'imageDownloadStatus']
 # global dictionary of all fashion products like - top, bottom, dress, accessories etc.
 # key = uniqueId (which is unique within a website), value = other metadata related to the item
-g_items = {}
+# compact dictionary like store, its sets are copies, see itemStore.py
+g_items = itemStore.ItemStore()
 g_items_csv_file_path = '/MANGO/items_image_status.csv'
 g_images_output_path = '/MANGOIMAGES/'
+# content addressed store, every image url is downloaded once and stored under the sha256 of its content
+# as store/<2 hex>/<2 hex>/<sha256>.<ext>, the item directories hold hardlinks to the store files
+g_image_store_path = '/MANGOIMAGES/store/'
+# download engine, the images of all the items are downloaded in parallel over one keep-alive connection pool
+g_download_workers = 16 # images downloaded at the same time, override with --workers
+g_host_concurrency = 8 # requests in flight per host, image CDNs throttle above a few connections
+g_http_timeout = 30 # seconds
+# only files above this size are split into parallel range requests, a product jpeg is one plain GET
+g_range_split_threshold = 8 * 1024 * 1024 # bytes
+g_range_parts = 5
+g_chunk_size = 64 * 1024 # bytes buffered per response, memory stays flat whatever the image size
+# one json record per line and per state change of an image, keyed by image url, the last record of a url wins
+# a rerun skips the complete images, resumes the partial ones with a range request and retries the failed ones
+g_manifest_file_path = '/MANGO/images_manifest.jsonl'
+# the items are also written to items_image_status.parquet and read from it when it is up to date, override with --parquet
+g_parquet_output = False
 
 g_logger_file_path = '/session-logs/' #prefix with date
 loggerFilePath = os.getcwd()+ g_logger_file_path + time.strftime('%m-%d-%y') + '.log'  
@@ -38,64 +68,253 @@ fh.setFormatter(formatter)
 ch.setFormatter(formatter)
 
 # add the handlers to the logger
+
+# one session for all the download threads, its urllib3 connection pool is thread safe and keeps the connections
+# alive across items. The session holds no cookies or per request state, so sharing it is safe
+g_http_session = None
+g_http_session_lock = threading.Lock()
+# host -> semaphore bounding the requests in flight to that host
+g_host_slots = {}
+# image url -> last manifest record {'url', 'path', 'state', 'size', 'etag', 'sha256', 'ranges'}
+# state = 'downloading' (headers received), 'complete' or 'failed'
+g_manifest = {}
+g_manifest_fp = None
+g_manifest_lock = threading.Lock()
+# striped locks serializing storeImage() per url, two items listing the same image must not download it into the same .part
+g_store_locks = [threading.Lock() for i in range(64)]
+
+def getHttpSession():
+    global g_http_session
+    with g_http_session_lock:
+        if g_http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=g_host_concurrency, pool_maxsize=g_download_workers + g_range_parts * g_host_concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            g_http_session = session
+        return g_http_session
+
+# holds one of the g_host_concurrency request slots of the host of the url
+@contextmanager
+def hostSlot(url):
+    host = urlparse(url).netloc
+    with g_http_session_lock:
+        if host not in g_host_slots:
+            g_host_slots[host] = threading.BoundedSemaphore(g_host_concurrency)
+        slot = g_host_slots[host]
+    with slot:
+        yield
+
 # The below code is used for each chunk of file handled
 # by each thread for downloading the content from specified 
 # location to storage
-def Handler(start, end, url, filename):
+# the range is streamed g_chunk_size bytes at a time with positional writes on the shared file descriptor
+# returns the number of bytes written
+def Handler(start, end, url, fd):
     # specify the starting and ending of the file
     headers = {'Range': 'bytes=%d-%d' % (start, end)}
 
-    # request the specified part and get into variable    
-    r = requests.get(url, headers=headers, stream=True)
+    with hostSlot(url):
+        r = getHttpSession().get(url, headers=headers, stream=True, timeout=g_http_timeout)
+        try:
+            r.raise_for_status()
+            #a server ignoring the range sends the whole file with 200
+            if r.status_code != 206:
+                raise IOError('range %d-%d of %s answered with status %d' % (start, end, url, r.status_code))
+            offset = start
+            for chunk in r.iter_content(g_chunk_size):
+                if offset + len(chunk) > end + 1:
+                    raise IOError('range %d-%d of %s is longer than requested' % (start, end, url))
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+        finally:
+            r.close()
+    return offset - start
+
+# streams a response body to a file, g_chunk_size bytes at a time, returns the number of bytes written
+def writeResponse(r, fp):
+    written = 0
+    for chunk in r.iter_content(g_chunk_size):
+        fp.write(chunk)
+        written += len(chunk)
+    return written
+
+# loads the manifest of the previous runs and opens it for appending
+def openManifest():
+    global g_manifest_fp
+    manifestPath = os.getcwd() + g_manifest_file_path
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #last line of a crashed run
+                    continue
+                g_manifest[record['url']] = record
+    g_manifest_fp = open(manifestPath, 'a')
+
+# rewrites the manifest with only the last record of every url and closes it
+def closeManifest():
+    global g_manifest_fp
+    manifestPath = os.getcwd() + g_manifest_file_path
+    with g_manifest_lock:
+        #not opened, the manifest on disk is the only copy
+        if g_manifest_fp is None:
+            return
+        g_manifest_fp.close()
+        g_manifest_fp = None
+        with open(manifestPath + '.tmp', 'w') as fp:
+            for record in g_manifest.values():
+                fp.write(json.dumps(record) + '\n')
+        os.replace(manifestPath + '.tmp', manifestPath)
+
+# merges the fields in the record of the url and appends the record to the manifest, flushed right away
+def updateManifest(url, **fields):
+    with g_manifest_lock:
+        record = dict(g_manifest.get(url, {}), url=url, **fields)
+        g_manifest[url] = record
+        if g_manifest_fp is not None:
+            g_manifest_fp.write(json.dumps(record) + '\n')
+            g_manifest_fp.flush()
+
+def getManifestRecord(url):
+    with g_manifest_lock:
+        return g_manifest.get(url)
 
-    # open the file and write the content of the html page 
-    # into file.
-    with open(filename, "r+b") as fp:
-        fp.seek(start)
-        var = fp.tell()
-        fp.write(r.content)
+def fileChecksum(fileName):
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(g_chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
+# True when the manifest says the image was downloaded and the file is still there with its size
+def isCompleteFile(record, fileName):
+    return record is not None and record.get('state') == 'complete' and os.path.exists(fileName) and os.path.getsize(fileName) == record.get('size')
+
+# downloads the file with one GET, the response headers tell whether the file is large enough to be worth
+# splitting into number_of_threads range requests, so small files cost a single request (no HEAD first)
+# the body is written to <file>.part and renamed to the file only once it is complete, so an existing file is never partial
+# a .part file left by an interrupted single stream download is resumed with a Range/If-Range request
+# (committed without a request when it already has the recorded size, downloaded again when the server answers 416)
+# every state change is recorded in the manifest
 #def download_file(ctx,url_of_file,name,number_of_threads):
 def download_file(url_of_file,path,name,number_of_threads):
-    r = requests.head(url_of_file)
     if name:
         file_name = path + name
     else:
         file_name = path + url_of_file.split('/')[-1]
+    part_file_name = file_name + '.part'
+
+    record = getManifestRecord(url_of_file)
+    if isCompleteFile(record, file_name):
+        return True
+
+    headers = {}
+    offset = 0
+    if record and record.get('state') == 'downloading' and record.get('path') == file_name and record.get('etag') and not record.get('ranges') and os.path.exists(part_file_name):
+        offset = os.path.getsize(part_file_name)
+        #crashed between the last write and the rename, the body is all there
+        if offset == record.get('size'):
+            g_logger.debug('download_file() %s was fully received by the previous run', url_of_file)
+            os.replace(part_file_name, file_name)
+            updateManifest(url_of_file, state='complete', size=offset, sha256=fileChecksum(file_name))
+            return True
+        if offset:
+            headers = {'Range': 'bytes=%d-' % offset, 'If-Range': record['etag']}
+
     try:
-        file_size = int(r.headers['content-length'])
+        with hostSlot(url_of_file):
+            r = getHttpSession().get(url_of_file, headers=headers, stream=True, timeout=g_http_timeout)
+            try:
+                #the .part does not match the file on the server any more, it is downloaded again once the host slot is released
+                restart = offset and r.status_code == 416
+                if not restart:
+                    r.raise_for_status()
+                    #the file changed since the partial download, If-Range makes the server send all of it
+                    if offset and r.status_code != 206:
+                        offset = 0
+                    file_size = int(r.headers.get('content-length', -1))
+                    if file_size != -1:
+                        file_size += offset
+                    splitRanges = not offset and number_of_threads > 1 and file_size > g_range_split_threshold and r.headers.get('accept-ranges') == 'bytes'
+                    #a 206 answer to a resume proves the range support even without accept-ranges, and If-Range matched
+                    #so the stored etag still names the file when the response does not repeat it
+                    etag = r.headers.get('etag') if r.status_code == 206 or r.headers.get('accept-ranges') == 'bytes' else None
+                    if etag is None and r.status_code == 206:
+                        etag = record['etag']
+                    updateManifest(url_of_file, path=file_name, state='downloading', size=file_size, etag=etag, ranges=splitRanges)
+                    if offset:
+                        g_logger.debug('download_file() resuming %s at %d bytes', url_of_file, offset)
+                    if not splitRanges:
+                        with open(part_file_name, "ab" if offset else "wb") as fp:
+                            written = offset + writeResponse(r, fp)
+                        #no content-length with chunked transfer encoding
+                        if file_size != -1 and written != file_size:
+                            raise IOError('%s is %d bytes, expected %d' % (url_of_file, written, file_size))
+            finally:
+                r.close()
+
+        if restart:
+            g_logger.warning('download_file() %s cannot be resumed at %d bytes, downloading it again', url_of_file, offset)
+            os.remove(part_file_name)
+            updateManifest(url_of_file, path=file_name, state='failed')
+            return download_file(url_of_file, path, name, number_of_threads)
+        if splitRanges:
+            g_logger.debug('download_file() %s is %d bytes, %d range requests', url_of_file, file_size, number_of_threads)
+            download_ranges(url_of_file, part_file_name, file_size, number_of_threads)
+        os.replace(part_file_name, file_name)
+        updateManifest(url_of_file, state='complete', size=os.path.getsize(file_name), sha256=fileChecksum(file_name))
+        return True
     except:
-        g_logger.error("Invalid URL")
+        g_logger.exception('FAILED to download %s', url_of_file)
+        record = getManifestRecord(url_of_file)
+        #keep what was received when the next run can resume it
+        if not (record and record.get('state') == 'downloading' and record.get('etag') and not record.get('ranges')):
+            if os.path.exists(part_file_name):
+                os.remove(part_file_name)
+            updateManifest(url_of_file, path=file_name, state='failed')
         return False
 
+# parallel range requests of a large file, returns when all the ranges are written and have the expected length
+# the file is preallocated with a sparse truncate, no zero bytes are written
+def download_ranges(url_of_file, file_name, file_size, number_of_threads):
+    part = int(file_size) / number_of_threads
+    fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
     try:
-        g_logger.debug('+++++++++', file_size)
-        part = int(file_size) / number_of_threads
-        fp = open(file_name, "wb")
-        fp.write(b"\0" * file_size)
-        fp.close()
+        os.ftruncate(fd, file_size)
 
+        threads = []
+        errors = []
+        written = [0] * number_of_threads
+        ranges = []
         for i in range(number_of_threads):
             start = int(part * i)
-            end = int(start + part)
+            end = int(part * (i + 1)) - 1
+            ranges.append((start, end))
 
             # create a Thread with start and end locations
-            t = threading.Thread(target=Handler,
-            kwargs={'start': start, 'end': end, 'url': url_of_file, 'filename': file_name})
-            t.setDaemon(True)
+            def run(i=i, start=start, end=end):
+                try:
+                    written[i] = Handler(start, end, url_of_file, fd)
+                except Exception as e:
+                    errors.append(e)
+            t = threading.Thread(target=run, daemon=True)
             t.start()
+            threads.append(t)
 
-            main_thread = threading.current_thread()
-            for t in threading.enumerate():
-                if t is main_thread:
-                    continue
-                t.join()
-            print('%s downloaded' % file_name)
-
-        return True
-    except:
-        g_logger.exception('FAILED to download' % file_name)
-        return False
+        # only the threads of this file, the other downloads keep running
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        for i, (start, end) in enumerate(ranges):
+            if written[i] != end - start + 1:
+                raise IOError('range %d-%d of %s is %d bytes' % (start, end, url_of_file, written[i]))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def readCSVToDict(csvFile):
@@ -104,11 +323,21 @@ def readCSVToDict(csvFile):
             with open(csvFile) as csvfile:
                 reader = csv.DictReader(csvfile)
                 for row in reader:
-                    convertRowToAA(row)
+                    # DictReader rows are plain dicts since python 3.8, popitem(False) needs an OrderedDict
+                    convertRowToAA(OrderedDict(row))
 
         except IOError:
             g_logger.error("I/O error({0}): {1}".format(errno, strerror))
 
+# loads the parquet copy of the csv when it is up to date, the csv otherwise
+def readTableToDict(csvFile):
+    parquetFile = columnarStore.getFreshParquetPath(csvFile) if g_parquet_output else None
+    if parquetFile is None:
+        readCSVToDict(csvFile)
+        return
+    for row in columnarStore.readParquetRows(parquetFile):
+        convertRowToAA(row)
+
 def convertRowToAA(row):
     if row:
         # ecah row is an ordered dictionary
@@ -128,7 +357,8 @@ def sanitizeCSVRow(row):
     while row:
         key, value = row.popitem(False)
         if key == 'imageUrls' or key == 'priceArray' or key == 'outfitIds' or key == 'outfitUrls':
-            aa[key] = set(value.split(g_delimiter))
+            #the parquet rows already hold lists
+            aa[key] = set(value) if isinstance(value, list) else set(value.split(g_delimiter))
         else:
             aa[key] = value
     return aa
@@ -165,6 +395,12 @@ def writeDictToCSV(csvFile, csvColumns, dictionary):
     except IOError:
         g_logger.error("I/O error({0}): {1}".format(errno, strerror))    
 
+# writeDictToCSV() and its parquet copy, written after the csv
+def writeItems(csvFile):
+    writeDictToCSV(csvFile, g_items_column, g_items)
+    if g_parquet_output:
+        columnarStore.writeDictToParquet(columnarStore.getParquetPath(csvFile), g_items_column, g_items.items(), g_delimiter)
+
 
 # sanitize url, throw away query params
 def sanitizeUrl(url):
@@ -174,40 +410,164 @@ def sanitizeUrl(url):
             url =  url[:queryParam]
     return url 
 
+# key of an image in the manifest and the store : no query string or fragment, lower case scheme and host
+def normalizeImageUrl(url):
+    o = urlparse(sanitizeUrl(url))
+    return urlunparse((o.scheme.lower(), o.netloc.lower(), o.path, '', '', ''))
+
+def getImageExtension(url):
+    return os.path.splitext(urlparse(url).path)[1].lower()
+
+def getStorePath(sha256, extension):
+    return os.getcwd() + g_image_store_path + sha256[:2] + '/' + sha256[2:4] + '/' + sha256 + extension
+
+# downloads the image into the store unless it is already there, returns the store path or None when the download failed
+# the download goes to store/downloads/<sha1 of the url> so an interrupted one is resumed, then moves to its content path,
+# an image with the same content under another url is only kept once
+def storeImage(url):
+    with g_store_locks[hash(url) % len(g_store_locks)]:
+        return storeImageLocked(url)
+
+def storeImageLocked(url):
+    record = getManifestRecord(url)
+    if record and isCompleteFile(record, record.get('path', '')) and record['path'].startswith(os.getcwd() + g_image_store_path):
+        return record['path']
+
+    downloadDirectory = os.getcwd() + g_image_store_path + 'downloads/'
+    extension = getImageExtension(url)
+    if not download_file(url, downloadDirectory, hashlib.sha1(url.encode('utf-8')).hexdigest() + extension, g_range_parts):
+        return None
+
+    record = getManifestRecord(url)
+    storePath = getStorePath(record['sha256'], extension)
+    if os.path.exists(storePath):
+        os.remove(record['path'])
+    else:
+        os.makedirs(os.path.dirname(storePath), exist_ok=True)
+        os.replace(record['path'], storePath)
+    updateManifest(url, path=storePath)
+    return storePath
+
+# links the store file in the item directory, copies it when the filesystem has no hardlinks
+def linkImage(storePath, fileName):
+    if os.path.exists(fileName):
+        if os.path.samefile(storePath, fileName):
+            return
+        os.remove(fileName)
+    try:
+        os.link(storePath, fileName)
+    except OSError:
+        shutil.copyfile(storePath, fileName)
+
+# stores the images of one item and links them in its directory, returns False when one of them failed
+# @imageUrls = the imageUrls of the item, as crawled
+def downloadItemImages(uniqueId, imageUrls):
+    itemDirectory = os.getcwd() + g_images_output_path + uniqueId + "/"
+    os.makedirs(itemDirectory, exist_ok=True)
+    result = True
+    for imageurl in imageUrls:
+        url = sanitizeUrl(imageurl)
+        if url:
+            storePath = storeImage(normalizeImageUrl(url))
+            if storePath is None:
+                result = False
+            else:
+                linkImage(storePath, itemDirectory + url.split('/')[-1])
+    return result
+
+# downloads the images of all the items with g_download_workers threads, every distinct image url once even when
+# several items (color variants, outfits) list it, the images of different items are downloaded at the same time,
+# bounded per host by g_host_concurrency
 def downloadAllImages():
     directory = os.getcwd() + g_images_output_path
+    os.makedirs(os.getcwd() + g_image_store_path + 'downloads/', exist_ok=True)
+    # image url -> list of (item, file name in the item directory)
+    images = {}
     for item in g_items:
         itemDirectory = directory + item + "/"
         if not os.path.exists(itemDirectory):
             os.makedirs(itemDirectory)
-        g_logger.debug('++++++', itemDirectory)
         for imageurl in g_items[item]['imageUrls']:
             url = sanitizeUrl(imageurl)
             if url:
-                if not download_file(url,itemDirectory,'',5):
-                    g_items[item]['imageDownloadStatus'] = 'failed'
+                images.setdefault(normalizeImageUrl(url), []).append((item, itemDirectory + url.split('/')[-1]))
+
+    #the item status is only written from this thread, once all the images of the item are resolved
+    #an item whose images were not all fetched (interrupted run) keeps the status of the previous run
+    pending = dict([(item, 0) for item in g_items])
+    for url in images:
+        for item, fileName in images[url]:
+            pending[item] += 1
+    failed = set()
+    for item in g_items:
+        if pending[item] == 0:
+            g_items[item]['imageDownloadStatus'] = 'complete'
+
+    with ThreadPoolExecutor(max_workers=g_download_workers) as executor:
+        futures = {}
+        for url in images:
+            futures[executor.submit(storeImage, url)] = url
+
+        g_logger.debug('downloadAllImages() %d distinct images of %d items', len(futures), len(g_items))
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                storePath = future.result()
+            except Exception:
+                g_logger.exception('downloadAllImages() FAILED to store %s', url)
+                storePath = None
+            for item, fileName in images[url]:
+                if storePath is None:
+                    failed.add(item)
+                else:
+                    try:
+                        linkImage(storePath, fileName)
+                    except Exception:
+                        g_logger.exception('downloadAllImages() FAILED to link %s', fileName)
+                        failed.add(item)
+                pending[item] -= 1
+                if pending[item] == 0:
+                    g_items[item]['imageDownloadStatus'] = 'failed' if item in failed else 'complete'
 
 #main function
 #python lets you use the same source file as a reusable module or standalone
 #when python runs it as standalone, it sends __name__ with value "__main__"
-if __name__ == "__main__":
+@click.command(help="Downloads the images of all the items of the items csv")
+@click.option('--workers', default=g_download_workers, help="Images downloaded at the same time")
+@click.option('--host-concurrency', default=g_host_concurrency, help="Requests in flight per host")
+@click.option('--range-threshold', default=g_range_split_threshold, help="Files above this size in bytes are downloaded with parallel range requests")
+@click.option('--parquet', is_flag=True, help="Also write the items as parquet and read them from it when it is up to date")
+def main(workers, host_concurrency, range_threshold, parquet):
+    global g_download_workers, g_host_concurrency, g_range_split_threshold, g_parquet_output
+    g_download_workers = workers
+    g_host_concurrency = host_concurrency
+    g_range_split_threshold = range_threshold
+    g_parquet_output = parquet
+    if g_parquet_output and not columnarStore.isAvailable():
+        raise click.UsageError('--parquet needs pyarrow')
     try:
         currentPath = os.getcwd()
         itemCSVPath = currentPath + g_items_csv_file_path
         print('DEBUG', itemCSVPath)
         #load the csv as dictionary	
-        readCSVToDict(itemCSVPath)
+        readTableToDict(itemCSVPath)
+        openManifest()
         downloadAllImages()
         g_logger.debug('Program finished, items in dictionary %d', len(g_items))
-        writeDictToCSV(itemCSVPath, g_items_column, g_items)
+        writeItems(itemCSVPath)
 
     except:
         #keyboard interrupt
         g_logger.debug('Program finished, with exception %d', len(g_items))
         traceback.print_exc()
         if g_items:
-            writeDictToCSV(itemCSVPath, g_items_column, g_items)
-        
+            writeItems(itemCSVPath)
+    finally:
+        closeManifest()
+
+if __name__ == "__main__":
+    main()
+
 #@click.command(help="It downloads the specified file with specified name")
 #@click.option('--number_of_threads',default=4, help="No of Threads")
 #@click.option('--name',type=click.Path(),help="Name of the file with extension")
@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+
+# packs the images downloaded by imageDownloader.py into training shards
+# every image of /MANGOIMAGES/<uniqueId>/ is decoded and validated on a process pool, corrupt files are dropped and the
+# others are resized (center crop) to every training resolution, then appended to
+#   tar shards : shard-<width>x<height>-<n>.tar, members <uniqueId>/<image>.jpg, read sequentially or sliced from an mmap
+#   memmap shards : shard-<width>x<height>-<n>.npy, uint8 arrays of shape (images, height, width, 3)
+# index.jsonl lists every packed image with its uniqueId, shard and position, a rerun only processes the new or changed files
+
+import click
+from concurrent.futures import ProcessPoolExecutor
+import io
+import json
+import os
+import os.path
+import tarfile
+import time
+import logging
+import traceback
+
+from PIL import Image
+from PIL import ImageOps
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+g_images_output_path = '/MANGOIMAGES/'
+g_image_store_directory = 'store' # content addressed store of imageDownloader.py, the item directories link to it
+g_shards_output_path = '/MANGOSHARDS/'
+g_index_file_name = 'index.jsonl'
+g_training_sizes = [(224, 224)] # (width, height), override with --size 224x224 --size 512x512
+g_shard_format = 'tar' # 'tar' or 'memmap', memmap needs numpy
+g_shard_max_images = 2000 # images per shard, a rerun starts new shards so the existing ones are never rewritten
+g_jpeg_quality = 90
+g_workers = os.cpu_count() or 1
+g_image_extensions = set(['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'])
+
+g_logger_file_path = '/session-logs/' #prefix with date
+loggerFilePath = os.getcwd()+ g_logger_file_path + time.strftime('%m-%d-%y') + '.log'
+
+#create a logger for imagepreprocess
+g_logger = logging.getLogger('imagePreprocess')
+g_logger.setLevel(logging.DEBUG)
+
+#create file handler which logs even debug messages
+fh = logging.FileHandler(loggerFilePath)
+fh.setLevel(logging.DEBUG)
+
+#create console handler with same log level
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+
+#create a formatter and add it to the handlers
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+fh.setFormatter(formatter)
+ch.setFormatter(formatter)
+
+# add the handlers to the logger
+g_logger.addHandler(fh)
+g_logger.addHandler(ch)
+
+# key of a source image in the index
+def getImageKey(uniqueId, name):
+    return uniqueId + '/' + name
+
+# (size, mtime) of a source file, an image whose file changed is processed again
+def getFileVersion(path):
+    stat = os.stat(path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+# lists the (uniqueId, name, path) of all the downloaded images, item by item
+def listImages(directory):
+    images = []
+    for uniqueId in sorted(os.listdir(directory)):
+        itemDirectory = os.path.join(directory, uniqueId)
+        if uniqueId == g_image_store_directory or not os.path.isdir(itemDirectory):
+            continue
+        for name in sorted(os.listdir(itemDirectory)):
+            if os.path.splitext(name)[1].lower() in g_image_extensions:
+                images.append((uniqueId, name, os.path.join(itemDirectory, name)))
+    return images
+
+# index of the previous runs, key -> last record
+def readIndex(indexPath):
+    index = {}
+    if os.path.exists(indexPath):
+        with open(indexPath) as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #last line of a crashed run
+                    continue
+                index[record['key']] = record
+    return index
+
+# runs in the worker processes : decodes and validates the image and resizes it to every training size
+# returns (path, {size : jpeg bytes or raw rgb bytes}) or (path, error message) when the file is corrupt
+def processImage(path, sizes, shardFormat, quality):
+    try:
+        #verify() checks the file structure, it leaves the image unusable so it is opened again to decode it
+        with Image.open(path) as image:
+            image.verify()
+        with Image.open(path) as image:
+            image.load()
+            image = image.convert('RGB')
+            resized = {}
+            for width, height in sizes:
+                fitted = ImageOps.fit(image, (width, height), Image.LANCZOS)
+                if shardFormat == 'memmap':
+                    resized['%dx%d' % (width, height)] = fitted.tobytes()
+                else:
+                    buffer = io.BytesIO()
+                    fitted.save(buffer, 'JPEG', quality=quality)
+                    resized['%dx%d' % (width, height)] = buffer.getvalue()
+            return (path, resized)
+    except Exception as e:
+        return (path, '%s: %s' % (type(e).__name__, e))
+
+# appends the images of one resolution to shards of at most g_shard_max_images images
+# the shard being written is only listed in the index once it is closed, a crashed run leaves no half indexed shard
+class ShardWriter(object):
+    def __init__(self, directory, resolution, shardFormat, firstShard):
+        self.directory = directory
+        self.resolution = resolution
+        self.width, self.height = [int(v) for v in resolution.split('x')]
+        self.shardFormat = shardFormat
+        self.shardNumber = firstShard
+        self.shard = None
+        self.count = 0
+        self.records = []
+
+    def getShardName(self):
+        return 'shard-%s-%06d.%s' % (self.resolution, self.shardNumber, 'npy' if self.shardFormat == 'memmap' else 'tar')
+
+    def open(self):
+        path = os.path.join(self.directory, self.getShardName() + '.part')
+        if self.shardFormat == 'memmap':
+            self.shard = numpy.lib.format.open_memmap(path, mode='w+', dtype=numpy.uint8, shape=(g_shard_max_images, self.height, self.width, 3))
+        else:
+            self.shard = tarfile.open(path, 'w', format=tarfile.GNU_FORMAT)
+        self.count = 0
+
+    # returns the index records of the shard when it got full and was closed
+    def add(self, key, uniqueId, name, version, data):
+        if self.shard is None:
+            self.open()
+        record = {'key' : key, 'uniqueId' : uniqueId, 'name' : name, 'version' : version, 'state' : 'packed',
+            'resolution' : self.resolution, 'shard' : self.getShardName()}
+        if self.shardFormat == 'memmap':
+            self.shard[self.count] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(self.height, self.width, 3)
+            record['row'] = self.count
+        else:
+            info = tarfile.TarInfo(getImageKey(uniqueId, os.path.splitext(name)[0] + '.jpg'))
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.shard.addfile(info, io.BytesIO(data))
+            #offset of the jpeg bytes in the tar, a reader can slice them out of an mmap of the shard
+            #addfile() leaves the tar offset after the data padded to tarfile.BLOCKSIZE
+            record['offset'] = self.shard.offset - ((info.size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            record['size'] = info.size
+        self.records.append(record)
+        self.count += 1
+        if self.count >= g_shard_max_images:
+            return self.close()
+        return []
+
+    def close(self):
+        if self.shard is None:
+            return []
+        path = os.path.join(self.directory, self.getShardName())
+        if self.shardFormat == 'memmap':
+            self.shard.flush()
+            del self.shard
+            if self.count < g_shard_max_images:
+                #shrink the last shard to the images it holds
+                full = numpy.load(path + '.part', mmap_mode='r')
+                trimmed = numpy.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=numpy.uint8, shape=(self.count, self.height, self.width, 3))
+                trimmed[:] = full[:self.count]
+                trimmed.flush()
+                del trimmed, full
+                os.replace(path + '.tmp', path + '.part')
+        else:
+            self.shard.close()
+        os.replace(path + '.part', path)
+        self.shard = None
+        self.shardNumber += 1
+        records = self.records
+        self.records = []
+        return records
+
+# next free shard number of a resolution, the shards of the previous runs are kept as they are
+def getFirstShard(directory, resolution):
+    numbers = [int(name.split('-')[2].split('.')[0]) for name in os.listdir(directory) if name.startswith('shard-%s-' % resolution) and not name.endswith('.part')]
+    return max(numbers) + 1 if numbers else 0
+
+# processes the images that are not in the index yet (or whose file changed) and appends them to new shards
+def preprocessAllImages():
+    imagesDirectory = os.getcwd() + g_images_output_path
+    shardsDirectory = os.getcwd() + g_shards_output_path
+    if not os.path.exists(shardsDirectory):
+        os.makedirs(shardsDirectory)
+    if g_shard_format == 'memmap' and numpy is None:
+        raise ImportError('the memmap shard format needs numpy')
+    indexPath = shardsDirectory + g_index_file_name
+    index = readIndex(indexPath)
+
+    resolutions = ['%dx%d' % size for size in g_training_sizes]
+    pending = {}
+    for uniqueId, name, path in listImages(imagesDirectory):
+        key = getImageKey(uniqueId, name)
+        version = getFileVersion(path)
+        #a corrupt file is only tried again once it changed
+        if key in index and index[key]['version'] == version:
+            continue
+        records = [index.get(key + '@' + resolution) for resolution in resolutions]
+        if all([record is not None and record['version'] == version for record in records]):
+            continue
+        pending[path] = (key, uniqueId, name, version)
+    g_logger.info('preprocessAllImages() %d new images, %d already in the index', len(pending), len(index))
+    if not pending:
+        return
+
+    writers = dict([(resolution, ShardWriter(shardsDirectory, resolution, g_shard_format, getFirstShard(shardsDirectory, resolution))) for resolution in resolutions])
+    packed = 0
+    corrupt = 0
+    with open(indexPath, 'a') as indexFile, ProcessPoolExecutor(max_workers=g_workers) as executor:
+        def writeRecords(records):
+            for record in records:
+                #one record per image and resolution
+                if record['state'] == 'packed':
+                    record = dict(record, key=record['key'] + '@' + record['resolution'])
+                indexFile.write(json.dumps(record) + '\n')
+            indexFile.flush()
+
+        paths = list(pending)
+        results = executor.map(processImage, paths, [g_training_sizes] * len(paths), [g_shard_format] * len(paths), [g_jpeg_quality] * len(paths), chunksize=16)
+        try:
+            for path, result in results:
+                key, uniqueId, name, version = pending[path]
+                if not isinstance(result, dict):
+                    g_logger.warning('preprocessAllImages() dropping corrupt image %s, %s', path, result)
+                    writeRecords([{'key' : key, 'uniqueId' : uniqueId, 'name' : name, 'version' : version, 'state' : 'corrupt'}])
+                    corrupt += 1
+                    continue
+                for resolution, data in result.items():
+                    writeRecords(writers[resolution].add(key, uniqueId, name, version, data))
+                packed += 1
+        finally:
+            for writer in writers.values():
+                writeRecords(writer.close())
+    g_logger.info('preprocessAllImages() packed %d images, dropped %d corrupt ones', packed, corrupt)
+
+def parseSize(value):
+    width, height = value.lower().split('x')
+    return (int(width), int(height))
+
+#main function
+#python lets you use the same source file as a reusable module or standalone
+#when python runs it as standalone, it sends __name__ with value "__main__"
+@click.command(help="Packs the downloaded images into resized training shards")
+@click.option('--size', 'sizes', multiple=True, help="Training resolution WIDTHxHEIGHT, repeat for several")
+@click.option('--format', 'shardFormat', type=click.Choice(['tar', 'memmap']), default=g_shard_format, help="Shard format")
+@click.option('--workers', default=g_workers, help="Worker processes")
+@click.option('--shard-size', default=g_shard_max_images, help="Images per shard")
+def main(sizes, shardFormat, workers, shard_size):
+    global g_training_sizes, g_shard_format, g_workers, g_shard_max_images
+    if sizes:
+        g_training_sizes = [parseSize(size) for size in sizes]
+    g_shard_format = shardFormat
+    g_workers = workers
+    g_shard_max_images = shard_size
+    try:
+        preprocessAllImages()
+    except:
+        g_logger.exception('preprocessAllImages() failed')
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    main()
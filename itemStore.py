@@ -0,0 +1,240 @@
+#!/usr/bin/python3
+
+# compact g_items for webScraper, imageDownloader and dataPostProcess
+# a dictionary of item dictionaries holding sets of strings costs several KB per item, the same category, color and
+# url prefixes being stored again in every item. ItemStore keeps one list of values per item, the column names are
+# shared by all the items, and
+#   the values of the intern columns (category, color, prices, description features) are interned, one copy per value
+#   a set is one string, every value is written as the number of its prefix in a table shared by the items, the text up
+#   to its last '/' (the directory of the urls, '' for the ids), followed by the rest of the value. The values are
+#   sorted and front coded, each one only keeps what differs from the previous one
+# g_items[uniqueId] is a dictionary like view of the item, g_items[uniqueId]['color'] = 'Red' writes through but the
+# sets it returns are copies : g_items[uniqueId]['outfitIds'] = outfitIds after changing them
+#
+# usage : python3 itemStore.py --items 20000 or python3 itemStore.py --csv MANGO/items.csv
+
+from collections.abc import MutableMapping
+import argparse
+import csv
+import io
+import sys
+import tracemalloc
+
+
+g_set_columns = ['imageUrls', 'priceArray', 'outfitIds', 'outfitUrls']
+g_intern_columns = ['category', 'color', 'priceArray', 'imageDownloadStatus']
+g_separator = '\n' # between the values of a set, urls and ids never hold one
+g_missing = object() # value of a column the item does not have
+
+
+# dictionary view of one item of an ItemStore
+class ItemRecord(MutableMapping):
+	__slots__ = ('store', 'values')
+
+	def __init__(self, store, values):
+		self.store = store
+		self.values = values
+
+	def __getitem__(self, column):
+		position = self.store.positions.get(column)
+		if position is None or position >= len(self.values) or self.values[position] is g_missing:
+			raise KeyError(column)
+		return self.store.decode(column, self.values[position])
+
+	def __contains__(self, column):
+		position = self.store.positions.get(column)
+		return position is not None and position < len(self.values) and self.values[position] is not g_missing
+
+	def __setitem__(self, column, value):
+		position = self.store.getPosition(column)
+		if position >= len(self.values):
+			self.values.extend([g_missing] * (position + 1 - len(self.values)))
+		self.values[position] = self.store.encode(column, value)
+
+	def __delitem__(self, column):
+		if column not in self:
+			raise KeyError(column)
+		self.values[self.store.positions[column]] = g_missing
+
+	def __iter__(self):
+		columns = self.store.columns
+		return iter([columns[i] for i, value in enumerate(self.values) if value is not g_missing])
+
+	def __len__(self):
+		return len([value for value in self.values if value is not g_missing])
+
+	def __repr__(self):
+		return repr(dict(self.items()))
+
+
+# uniqueId -> item, a drop in replacement of the g_items dictionaries
+# @columns = expected columns, the others get a position the first time an item has them
+# @setColumns = columns holding sets
+# @internColumns = columns with few distinct values
+class ItemStore(MutableMapping):
+	def __init__(self, columns=(), setColumns=g_set_columns, internColumns=g_intern_columns):
+		self.columns = []
+		self.positions = {}
+		self.prefixes = []
+		self.prefixNumbers = {}
+		self.setColumns = set(setColumns)
+		self.internColumns = set(internColumns)
+		self.records = {}
+		for column in columns:
+			self.getPosition(column)
+
+	def getPosition(self, column):
+		position = self.positions.get(column)
+		if position is None:
+			position = len(self.columns)
+			self.columns.append(column)
+			self.positions[column] = position
+		return position
+
+	def getPrefixNumber(self, prefix):
+		number = self.prefixNumbers.get(prefix)
+		if number is None:
+			number = len(self.prefixes)
+			self.prefixes.append(prefix)
+			self.prefixNumbers[prefix] = number
+		return number
+
+	# set -> 'shared,text\nshared,text...' where the values 'prefix number,rest' are sorted and every text follows
+	# the first shared characters of the previous value, equal sets are encoded the same and the interned columns
+	# share their encoding, an empty set is ''
+	# a value holding g_separator is kept in a frozenset instead
+	def encodeSet(self, values):
+		numbered = []
+		for value in values:
+			if g_separator in value:
+				return frozenset(values)
+			position = value.rfind('/') + 1
+			numbered.append('%d,%s' % (self.getPrefixNumber(value[:position]), value[position:]))
+		encoded = []
+		previous = ''
+		for value in sorted(numbered):
+			shared = 0
+			limit = min(len(value), len(previous))
+			while shared < limit and value[shared] == previous[shared]:
+				shared += 1
+			encoded.append('%d,%s' % (shared, value[shared:]))
+			previous = value
+		return g_separator.join(encoded)
+
+	def decodeSet(self, encoded):
+		if isinstance(encoded, frozenset):
+			return set(encoded)
+		values = set()
+		if encoded:
+			previous = ''
+			for entry in encoded.split(g_separator):
+				shared, text = entry.split(',', 1)
+				value = previous[:int(shared)] + text
+				number, rest = value.split(',', 1)
+				values.add(self.prefixes[int(number)] + rest)
+				previous = value
+		return values
+
+	# the value of a set column that is not a set is kept in a tuple, (None,) for None
+	def encode(self, column, value):
+		if column in self.setColumns:
+			if value is None or isinstance(value, str):
+				return (value,)
+			value = self.encodeSet(value)
+		if column in self.internColumns and isinstance(value, str):
+			return sys.intern(value)
+		return value
+
+	def decode(self, column, value):
+		if column in self.setColumns:
+			if isinstance(value, tuple):
+				return value[0]
+			return self.decodeSet(value)
+		return value
+
+	def __getitem__(self, uniqueId):
+		return ItemRecord(self, self.records[uniqueId])
+
+	def __contains__(self, uniqueId):
+		return uniqueId in self.records
+
+	# the item is copied into the store, later changes of the dictionary are not seen
+	def __setitem__(self, uniqueId, aa):
+		if isinstance(aa, ItemRecord) and aa.store is self:
+			self.records[uniqueId] = list(aa.values)
+			return
+		for column in aa:
+			self.getPosition(column)
+		values = [g_missing] * len(self.columns)
+		for column, value in aa.items():
+			values[self.positions[column]] = self.encode(column, value)
+		self.records[uniqueId] = values
+
+	def __delitem__(self, uniqueId):
+		del self.records[uniqueId]
+
+	def __iter__(self):
+		return iter(self.records)
+
+	def __len__(self):
+		return len(self.records)
+
+	def __repr__(self):
+		return 'ItemStore(%d items, %d columns)' % (len(self.records), len(self.columns))
+
+
+# synthetic items.csv with the shape of the mango items, the strings of every row are distinct objects like
+# the ones csv.DictReader returns
+def createSyntheticCSV(items):
+	categories = ['shirts-tops', 'dresses', 'jeans-skinny', 'coats-coats', 'skirts-midi', 'jackets-blazers', 'pants-straight']
+	colors = ['Black', 'White', 'Navy', 'Ecru', 'Red', 'Khaki', 'Grey']
+	features = ['Flowing fabric', 'Long sleeve', 'Round neckline', 'Button fastening', 'Two side pockets', 'Straight design',
+		'Smooth texture finish', 'Buttoned cuffs', 'Classic collar', 'Side slit', 'Lining: 100% viscose', 'Side seams']
+	output = io.StringIO()
+	writer = csv.writer(output)
+	writer.writerow(['uniqueId', 'itemName', 'category', 'priceArray', 'color', 'description', 'imageUrls', 'url', 'outfitIds'])
+	for i in range(items):
+		productId = 23000000 + i * 7
+		category = categories[i % len(categories)]
+		description = '|'.join([features[(i + j * 5) % len(features)] for j in range(6)] + ['Composition: %d%% cotton,%d%% polyester' % (40 + i % 50, 60 - i % 50)])
+		images = '|'.join(['https://st.mngbcn.com/rcs/pics/static/T2/fotos/S20/%d_%02d%s.jpg?ts=15%011d' % (productId, i % 99, suffix, i) for suffix in ['', '_B', '_D1', '_D2', '_D3', '_R']])
+		outfit = '|'.join(['REF. %d' % (23000000 + ((i + j * 31) % items) * 7) for j in range(1, 4)])
+		writer.writerow(['REF. %d' % productId, 'Synthetic item %d' % i, category, '%d.99|%d.99' % (19 + i % 5 * 10, 39 + i % 5 * 10), colors[i % len(colors)],
+			description, images, 'https://shop.mango.com/us/women/%s/synthetic-item_%d.html' % (category, productId), outfit])
+	return output.getvalue()
+
+# uniqueId -> item dictionary with sets, like sanitizeCSVRow() in the scripts
+def loadDictionaries(data, items):
+	for row in csv.DictReader(io.StringIO(data)):
+		uniqueId = row.pop('uniqueId')
+		items[uniqueId] = dict([(key, set(value.split('|')) if key in g_set_columns else value) for key, value in row.items()])
+	return items
+
+# bytes allocated by load() and kept after it returned
+def measure(load):
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	items = load()
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return items, after - before
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='memory of the items as dictionaries and in an ItemStore')
+	parser.add_argument('--items', type=int, default=20000, help='number of synthetic items')
+	parser.add_argument('--csv', help='measure the items of this csv instead of synthetic ones')
+	args = parser.parse_args()
+
+	if args.csv:
+		with open(args.csv) as fp:
+			data = fp.read()
+	else:
+		data = createSyntheticCSV(args.items)
+	dictionaries, dictionaryBytes = measure(lambda: loadDictionaries(data, {}))
+	store, storeBytes = measure(lambda: loadDictionaries(data, ItemStore()))
+	for uniqueId in dictionaries:
+		assert dict(store[uniqueId].items()) == dictionaries[uniqueId], uniqueId
+	print('%d items : dictionaries %.1f MB (%d bytes/item), ItemStore %.1f MB (%d bytes/item), %.1fx smaller' % (len(dictionaries),
+		dictionaryBytes / 1048576.0, dictionaryBytes / max(len(dictionaries), 1), storeBytes / 1048576.0, storeBytes / max(len(store), 1),
+		dictionaryBytes / float(max(storeBytes, 1))))
@@ -4,19 +4,39 @@
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException 
 from selenium.common.exceptions import StaleElementReferenceException 
+from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys  
 from urllib.parse import urlparse
+from urllib.parse import urlunparse
+
+# plain http fast path imports
+import requests
+from requests.adapters import HTTPAdapter
+import lxml.etree
+import lxml.html
+
+import columnarStore
+import crawlFrontier
+import crawlMetrics
+import itemStore
 
 # imports for file I/O
 from collections import OrderedDict
 import csv
+import hashlib
+import json
+import gzip
+import itertools
 import os
 import os.path
 import re #for regular expressions
 import heapq # use priority queue when we move to multithreading model
+import queue
+import threading
+import argparse
 import time
 import logging
 
@@ -25,10 +45,99 @@ import logging
 g_urls_csv_file_path = '/MANGO/urls.csv'
 g_items_csv_file_path = '/MANGO/items.csv'
 g_item_count_csv_file_path = '/MANGO/itemsCount.csv'
+# outfit urls not processed yet and the processed urls listing them, a restart relinks only these
+g_pending_outfit_urls_csv_file_path = '/MANGO/pendingOutfitUrls.csv'
 g_domain = 'shop.mango.com/us/women'
 g_blacklist = ['shop.mango.com/us/women/help/', 'shop.mango.com/us/men', 'javascript:window.open']
+# per retailer link rules on top of g_domain (allowed) and g_blacklist (denied), regular expressions searched in the href
+# a link is followed when it matches one of the allow rules and none of the deny rules, see getUrlRules()
+g_url_allow_patterns = []
+g_url_deny_patterns = []
 g_delimiter = '|'
+g_product_id_pattern = re.compile('_(\d+)\.html$')
 g_item_count_per_category = {}
+g_workers = 1 # number of concurrent webdriver sessions pulling from the shared frontier, override with --workers
+g_save_session_interval = 20 # pages processed between two saveSessionOutput() checkpoints
+# product pages are first fetched over plain http and parsed with lxml, the browser is used only
+# when one of the required fields is missing from the server rendered html (and for catalog pages)
+g_http_fast_path = True
+g_http_timeout = 10 # seconds
+g_http_pool_size = 10 # keep-alive connections per host in each worker's session
+g_http_headers = {'User-Agent' : 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36'}
+g_http_required_fields = ['itemName', 'priceArray', 'color', 'description', 'imageUrls']
+# read every field of a product page with one execute_script call instead of one round trip per element
+g_single_script_extraction = True
+# catalog scroll rounds end when the DOM did not change for g_catalog_idle_time ms, or when nothing changed
+# g_catalog_first_mutation_timeout ms after the scroll (the catalog is fully loaded then)
+g_catalog_idle_time = 300
+g_catalog_first_mutation_timeout = 2000
+g_catalog_max_round_time = 10000
+# lean page load profile, images are downloaded separately by imageDownloader.py so the crawl does not need them
+# the resource types are blocked through the url patterns listed for them, chrome can only block by url
+g_block_resources = True
+g_page_load_strategy = 'eager' # driver.get returns at DOMContentLoaded instead of the load event
+g_blocked_resource_types = ['image', 'font', 'media']
+g_resource_type_url_patterns = {
+	'image' : ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.svg', '*.ico', '*.bmp'],
+	'font' : ['*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot'],
+	'media' : ['*.mp4', '*.webm', '*.ogg', '*.mp3', '*.m3u8', '*.ts'],
+}
+g_blocked_url_patterns = ['*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*', '*facebook.net*', '*facebook.com/tr*', '*hotjar.com*', '*criteo.com*', '*criteo.net*', '*pinterest.com*', '*bing.com*', '*youtube.com*', '*nr-data.net*']
+# adaptive per host pacing (AIMD), every page load of every worker takes a slot of its host first
+# a slot is granted when fewer than 'concurrency' loads are in flight and 1/rate seconds passed since the previous one
+# success below g_host_latency_target adds g_host_rate_increase req/s and 1/concurrency to the concurrency,
+# errors, timeouts and slow pages multiply both by g_host_decrease_factor, throttling also backs off
+g_rate_limit = True
+g_host_initial_rate = 2.0 # requests per second
+g_host_min_rate = 0.1
+g_host_max_rate = 20.0
+g_host_rate_increase = 0.1
+g_host_initial_concurrency = 2
+g_host_max_concurrency = 16
+g_host_decrease_factor = 0.5
+g_host_latency_target = 8000 # ms, slower pages count as congestion
+g_host_backoff = 5 # seconds, doubled on every consecutive throttled response
+g_host_max_backoff = 300
+g_throttle_status_codes = [403, 429, 503]
+g_throttle_page_markers = ['Access Denied', 'Too Many Requests', 'Service Unavailable']
+g_page_load_timeout = 30 # seconds before driver.get raises a TimeoutException
+# revisit mode (--revisit) puts the processed urls that are due back in the new pipeline, products whose
+# fingerprint did not change are not rewritten and pages answering 304 to the conditional GET are not parsed at all
+# the interval between two visits is g_revisit_interval * (visits + 1) / (changes + 1), i.e. follows the observed change rate
+g_revisit = False
+g_revisit_interval = 86400 # seconds, also the interval of the catalog pages which list the new products
+g_revisit_max_interval = 30 * 86400
+g_revisit_slack = 3600 # a url due within the next hour is revisited now, so a daily refresh does not skip a day
+g_fingerprint_fields = ['itemName', 'category', 'priceArray', 'color', 'description', 'imageUrls']
+# webdriver lifecycle : warm standby sessions replace a failed or recycled session without a cold start
+# a session is recycled after g_driver_max_pages pages or when chrome uses more than g_driver_max_rss MB
+g_driver_standby = 1 # warm sessions kept ready, shared by all the workers
+g_driver_max_pages = 200
+g_driver_max_rss = 1500 # MB for chromedriver and all its chrome processes, 0 disables the check
+g_driver_rss_check_interval = 20 # pages between two rss checks, reading /proc is not free
+g_url_max_retries = 3 # a url failing more often is marked as processed with uniqueId FAILED
+# per stage latency histograms, throughput, frontier sizes, driver restarts and failures, see crawlMetrics.py
+g_metrics_port = 0 # local port serving /metrics (prometheus text) and /metrics.json, 0 disables it. Override with --metrics-port
+g_metrics_summary_interval = 60 # seconds between two 'metrics :' summary lines in the log, 0 disables them
+# pipelined image downloads (--download-images), every committed item is queued for the download threads of
+# imageDownloader.py while the crawl goes on. A full queue blocks the crawl workers until the downloads catch up
+# the image manifest of imageDownloader.py makes a restart resume the downloads, the items are queued again at startup
+g_download_images = False
+g_image_queue_size = 200 # items waiting for their images
+g_image_workers = 8 # download threads
+# between two compactions the checkpoints only append the changed urls, items and counts to this journal
+# the csv files above are the snapshot, recovery = snapshot + journal replay
+g_journal_file_path = '/MANGO/journal.log'
+g_journal_compress = False # every checkpoint is appended as one gzip member to journal.log.gz
+g_journal_compaction_interval = 50 # checkpoints between two full rewrites of the csv snapshot
+# the compactions also write urls.parquet, items.parquet and itemsCount.parquet, loaded instead of the csv files
+# when they are up to date, see columnarStore.py. Override with --parquet
+g_parquet_output = False
+# 'memory' keeps the url pipelines in the dictionaries below, 'sqlite' keeps them in g_frontier_db_file_path
+# with only a bounded hot cache in memory, for crawls that do not fit in RAM. Override with --frontier
+g_frontier_backend = 'memory'
+g_frontier_db_file_path = '/MANGO/frontier.db'
+g_frontier_cache_size = 100000 # urls kept in memory by the sqlite frontier
 g_logger_file_path = '/session-logs/' #prefix with date
 loggerFilePath = os.getcwd()+ g_logger_file_path + time.strftime('%m-%d-%y') + '.log'  
 
@@ -61,24 +170,202 @@ g_new_urls = {
 g_processing_urls = {}
 g_processed_urls = {}
 g_new_urls_heapq = [(0, 'https://shop.mango.com/us/women/shirts-tops/cotton-linen-peplum-top_81049029.html')]
+# crawlFrontier.SqliteFrontier when g_frontier_backend is 'sqlite', the three dictionaries above are then replaced by its views
+g_frontier = None
+# the same product is reachable through several category paths, all its urls end with the same _<digits>.html product id
+# product id -> canonical url of the product, only the first url seen for a product is queued
+g_product_id_index = {}
+# the other urls of a product, key = url, value = AA with status 'alias' and the canonical url
+# they are kept because the category in their path (extractCetegoryFromUrl) is another category of the product
+g_alias_urls = {}
+
+# every read/write of the url pipelines, the heapq and g_items goes through this lock so that
+# several webdriver sessions can share one frontier. It is reentrant because the helpers call each other
+g_lock = threading.RLock()
+# workers waiting for new urls sleep on this condition, it is notified whenever a url is added or a worker goes idle
+g_frontier_condition = threading.Condition(g_lock)
+g_active_workers = 0 # number of workers currently processing a url
+g_pages_since_save = 0
+# host -> pacing state, see acquireHostSlot(), guarded by its own condition so waiting never blocks the frontier
+g_host_state = {}
+g_host_condition = threading.Condition(threading.Lock())
+# warm webdriver sessions, see acquireDriver()
+g_standby_drivers = queue.Queue()
+g_standby_pending = 0 # sessions being started for the standby queue
+g_standby_lock = threading.Lock()
+# (uniqueId, imageUrls) of the items to download, see startImagePipeline() which also imports the imageDownloader module
+imageDownloader = None
+g_image_queue = None
+g_image_threads = []
+g_image_feeder = None
+# metrics of the session, the page load stats per page type are its 'page_loads', 'page_bytes' and 'page_resources' counters
+g_metrics = crawlMetrics.Metrics()
+g_checkpoints_since_compaction = 0
+# keys changed since the last checkpoint, written to the journal by saveSessionOutput()
+g_dirty_urls = set()
+g_dirty_items = set()
+g_dirty_categories = set()
+g_dirty_pending_outfit_urls = set()
+# outfit url not processed yet -> set of processed urls that list it in their outfitUrls
+g_pending_outfit_urls = {}
+# requests sessions are not thread safe, every worker gets its own pooled session
+g_http_local = threading.local()
+
+# runs in the page and returns all the raw fields of a product in one round trip, the python post processing
+# (price regex, color split, description join) is the same as for the webdriver path, see buildItemFromFields()
+# innerText is what WebElement.text returns, textContent what get_attribute('textContent') returns and
+# the href/src properties what get_attribute('href'/'src') returns
+# returns null when one of the elements is missing
+g_extract_features_script = '''
+var panel = "//*[@id='Form:SVFichaProducto:panelFicha']";
+function byXpath(path) {
+	return document.evaluate(path, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+}
+function isDisplayed(elem) {
+	var style = window.getComputedStyle(elem);
+	return style.display !== 'none' && style.visibility !== 'hidden' && (elem.offsetWidth > 0 || elem.offsetHeight > 0 || elem.getClientRects().length > 0);
+}
+var uniqueId = document.querySelector('div.referenciaProducto.row-fluid');
+if (!uniqueId) {
+	return null;
+}
+var fields = {'uniqueId' : uniqueId.innerText.trim()};
+if (fields.uniqueId.indexOf('REF') === -1) {
+	return fields;
+}
+var itemName = byXpath(panel + '/div[1]/div/div[1]/div[1]/h1');
+var price = byXpath(panel + '/div[1]/div/div[2]/div');
+var color = byXpath(panel + '/div[2]');
+var description = byXpath(panel + '/div[7]');
+var completeYourOutfit = document.querySelector('div.look.completa_look.accordion-body.in.collapse.span12');
+var imageDiv = byXpath("//*[@id='mainDivBody']/div/div[5]/div[2]");
+if (!itemName || !price || !color || !description || !completeYourOutfit || !imageDiv) {
+	return null;
+}
+fields.itemName = itemName.innerText.trim();
+fields.price = price.innerText.trim();
+fields.color = color.textContent;
+fields.description = description.textContent;
+fields.outfitHrefs = Array.prototype.filter.call(completeYourOutfit.getElementsByTagName('a'), isDisplayed).map(function (a) { return a.href; });
+fields.imageSrcs = Array.prototype.map.call(imageDiv.getElementsByTagName('img'), function (img) { return img.src; });
+return fields;
+'''
+
+# one scroll round of a catalog page, see harvestCatalog()
+# arguments = idle time after the last mutation, max wait for the first mutation and max round time, in ms
+# anchors are tagged with data-harvested so every anchor is returned once, count is the total for the page
+g_harvest_catalog_script = '''
+var idleTime = arguments[0], firstMutationTimeout = arguments[1], maxRoundTime = arguments[2];
+var done = arguments[arguments.length - 1];
+var catalog = document.getElementById('productCatalog');
+if (!catalog) {
+	done(null);
+	return;
+}
+var hrefs = [];
+function collect() {
+	var anchors = catalog.querySelectorAll('a:not([data-harvested])');
+	for (var i = 0; i < anchors.length; i++) {
+		anchors[i].setAttribute('data-harvested', '1');
+		hrefs.push(anchors[i].href);
+	}
+	window.harvestedAnchorCount = (window.harvestedAnchorCount || 0) + anchors.length;
+}
+var timer = null, deadline = null;
+var observer = new MutationObserver(function () {
+	clearTimeout(timer);
+	timer = setTimeout(finish, idleTime);
+});
+function finish() {
+	observer.disconnect();
+	clearTimeout(timer);
+	clearTimeout(deadline);
+	collect();
+	done({'hrefs' : hrefs, 'count' : window.harvestedAnchorCount});
+}
+collect();
+observer.observe(catalog, {childList : true, subtree : true});
+timer = setTimeout(finish, firstMutationTimeout);
+deadline = setTimeout(finish, maxRoundTime);
+window.scrollTo(0, document.body.scrollHeight);
+'''
+
+# bytes transferred by the current page (document + resources) from the resource timing api
+# cross origin resources without Timing-Allow-Origin report a transferSize of 0, so this is a lower bound
+g_page_stats_script = '''
+var entries = performance.getEntriesByType('navigation').concat(performance.getEntriesByType('resource'));
+var bytes = 0;
+for (var i = 0; i < entries.length; i++) {
+	bytes += entries[i].transferSize || 0;
+}
+return {'bytes' : bytes, 'resources' : entries.length};
+'''
+
+# every distinct href of the page in one round trip, null for the anchors without href attribute
+g_collect_hrefs_script = '''
+var anchors = document.getElementsByTagName('a');
+var seen = new Set();
+for (var i = 0; i < anchors.length; i++) {
+	if (anchors[i].hasAttribute('href')) {
+		seen.add(anchors[i].href);
+	}
+}
+return Array.from(seen);
+'''
 
 # IMPORTANT! these columns are the final table columns, edit here when you increase or decrease the columns
-g_urls_column = ['url', 'priority', 'status', 'outfitUrls', 'uniqueId']
+g_urls_column = ['url', 'priority', 'status', 'outfitUrls', 'uniqueId', 'fingerprint', 'etag', 'lastModified', 'lastVisit', 'revisitInterval', 'visits', 'changes', 'canonicalUrl', 'retries']
 
 # global dictionary of all fashion products like - top, bottom, dress, accessories etc.
 # key = uniqueId (which is unique within a website), value = other metadata related to the item
-g_items = {}
+# compact dictionary like store, its sets are copies, see itemStore.py
+g_items = itemStore.ItemStore()
 
 # IMPORTANT! these columns are the final table columns, edit here when you increase or decrease the columns
 g_items_column = ['uniqueId', 'itemName', 'category', 'priceArray', 'color', 'description', 'imageUrls', 'url', 'outfitIds']
 
 
 
-def addMultipleUrlsToDictionary(url, anchorList):
-	for link in anchorList:
-		href = sanitizeUrl(link.get_attribute('href'))
-		if href and href.find(g_domain) != -1 and not isBlacklistedDomain(href):
-			addUrlToDictionary(href, {'priority' : getPriority(url) + 100}) #non outfit urls have priority lower than outfits
+# reads all the hrefs of the page with one execute_script instead of one get_attribute() round trip per anchor
+def addPageLinksToDictionary(url, driver):
+	addMultipleHrefsToDictionary(url, driver.execute_script(g_collect_hrefs_script))
+
+# adds the links of a page to the new urls, filtered and deduplicated before taking the lock
+def addMultipleHrefsToDictionary(url, hrefList):
+	hrefs = filterHrefs(hrefList)
+	with g_lock:
+		priority = getPriority(url) + 100 #non outfit urls have priority lower than outfits
+		addUrlsToDictionary([(href, {'priority' : priority}) for href in hrefs])
+
+# compiled allow and deny rules, rebuilt only when the retailer config changed
+g_url_rules_cache = {}
+
+# returns (allow, deny) regular expressions, each one alternation of all the rules of its list, deny is None without rules
+def getUrlRules():
+	key = (g_domain, tuple(g_blacklist), tuple(g_url_allow_patterns), tuple(g_url_deny_patterns))
+	rules = g_url_rules_cache.get(key)
+	if rules is None:
+		allow = [re.escape(g_domain)] + g_url_allow_patterns
+		deny = [re.escape(domain) for domain in g_blacklist] + g_url_deny_patterns
+		rules = (re.compile('|'.join(['(?:%s)' % pattern for pattern in allow])), re.compile('|'.join(['(?:%s)' % pattern for pattern in deny])) if deny else None)
+		g_url_rules_cache.clear()
+		g_url_rules_cache[key] = rules
+	return rules
+
+# sanitized hrefs to follow, in page order, every href once
+# a link is followed when it is on the retailer domain (or matches an allow rule) and no blacklisted domain or deny rule matches it
+def filterHrefs(hrefList):
+	allow, deny = getUrlRules()
+	seen = set()
+	hrefs = []
+	for href in hrefList:
+		href = sanitizeUrl(href)
+		if not href or href in seen:
+			continue
+		seen.add(href)
+		if allow.search(href) is not None and (deny is None or deny.search(href) is None):
+			hrefs.append(href)
+	return hrefs
 
 
 # sanitize url, throw away query params
@@ -103,59 +390,278 @@ def sanitizeUrl(url):
 # it will also add the url to a min heapq based on its priority
 # @url 
 def addUrlToDictionary(url, aa):
-	if url and url not in g_new_urls and url not in g_processing_urls and url not in g_processed_urls:
-		g_new_urls[url] = aa
-		#g_logger.debug('++++++++++++++ pushing at ', str(aa['priority']), url)
-		heapq.heappush(g_new_urls_heapq, (int(aa['priority']), url)) 
+	addUrlsToDictionary([(url, aa)])
+
+# batched version of addUrlToDictionary()
+# @urls = list of (url, aa), the first occurrence of a url wins
+# the urls are canonicalized first, a url of a product that is already known is only recorded as an alias
+def addUrlsToDictionary(urls):
+	with g_lock:
+		newUrls = OrderedDict()
+		for url, aa in urls:
+			url = canonicalizeUrl(url)
+			if not url or url in newUrls or isUrlKnown(url):
+				continue
+			productId = extractProductId(url)
+			if productId:
+				productUrl = getProductUrl(productId)
+				if productUrl is None:
+					setProductUrl(productId, url)
+				elif productUrl != url:
+					addAliasUrl(url, productUrl, aa)
+					continue
+			newUrls[url] = aa
+		if not newUrls:
+			return
+
+		if g_frontier is not None:
+			# one transaction for the whole page, the priority index of the table replaces the heapq
+			g_frontier.addNewUrls(list(newUrls.items()))
+		else:
+			for url, aa in newUrls.items():
+				g_new_urls[url] = aa
+				#g_logger.debug('++++++++++++++ pushing at ', str(aa['priority']), url)
+				heapq.heappush(g_new_urls_heapq, (int(aa['priority']), url)) 
+		g_dirty_urls.update(newUrls)
+		g_frontier_condition.notify_all()
+
+# check if the url is in any of the pipelines or is an alias
+def isUrlKnown(url):
+	if g_frontier is not None:
+		return g_frontier.isKnown(url)
+	return url in g_new_urls or url in g_processing_urls or url in g_processed_urls or url in g_alias_urls
+
+# normalized form of a url : no query string, fragment or path parameters, lower case scheme and host,
+# no duplicate or trailing slashes
+def canonicalizeUrl(url):
+	if not url:
+		return url
+	o = urlparse(sanitizeUrl(url))
+	path = re.sub('/{2,}', '/', o.path)
+	if len(path) > 1:
+		path = path.rstrip('/')
+	return urlunparse((o.scheme.lower(), o.netloc.lower(), path, '', '', ''))
+
+#mango product urls end with _<product id>.html, e.g. https://shop.mango.com/us/women/coats-coats/oversize-wool-coat_11047664.html
+def extractProductId(url):
+	match = g_product_id_pattern.search(url)
+	if match:
+		return match.group(1)
+	return ''
+
+def getProductUrl(productId):
+	if g_frontier is not None:
+		return g_frontier.getProductUrl(productId)
+	return g_product_id_index.get(productId)
+
+def setProductUrl(productId, url):
+	if g_frontier is not None:
+		g_frontier.setProductUrl(productId, url)
+	else:
+		g_product_id_index.setdefault(productId, url)
+
+def addAliasUrl(url, productUrl, aa):
+	aa = dict(aa)
+	aa['status'] = 'alias'
+	aa['canonicalUrl'] = productUrl
+	g_alias_urls[url] = aa
+	g_dirty_urls.add(url)
+
+# url under which a link is tracked in the pipelines : canonical form, and the canonical url of the product for an alias
+def resolveUrl(url):
+	url = canonicalizeUrl(url)
+	if not url:
+		return url
+	with g_lock:
+		if url in g_alias_urls:
+			return g_alias_urls[url]['canonicalUrl']
+		productId = extractProductId(url)
+		if productId:
+			productUrl = getProductUrl(productId)
+			if productUrl:
+				return productUrl
+	return url
+
+# url with the lowest priority in the new pipeline, '' when there is none
+# the heapq can hold stale entries, the caller checks the url is still in g_new_urls
+def popNewUrl():
+	if g_frontier is not None:
+		return g_frontier.peekNewUrl()
+	if g_new_urls_heapq:
+		return heapq.heappop(g_new_urls_heapq)[1]
+	return ''
 
 # moves a particular url from 'processing' pipeline to 'processed' pipeline when all the links are successfully extracted from it
 # so we donot have to visit it again
 # @url = url to update
 # @uniqueId = uniqueid uniquiely identifies an item. Maintain uniqueID in the url dictionary to look it up in the items dictionary 
 # @outfitUrls = set of urls of items from 'complete your outfit' section. These are needed to collect outfit unique IDs
-def markUrlAsProcessed(url, uniqueId, outfitUrls):
-	if url and url in g_processing_urls:	
-		# move the url to 'processed' pipeline
-		aa = g_processing_urls[url]
-		g_processed_urls[url] = aa 
-		g_processed_urls[url]['uniqueId'] = uniqueId
-		g_processed_urls[url]['status'] = 'processed' #maintain the status for CSV 
-		if outfitUrls:
-			g_processed_urls[url]['outfitUrls'] = outfitUrls
-		# remove it from the processing pipeline
-		del g_processing_urls[url]
+# @visit = fingerprint and revisit fields of this visit, see getVisitFields()
+def markUrlAsProcessed(url, uniqueId, outfitUrls, visit=None):
+	with g_lock:
+		if url and url in g_processing_urls:	
+			# move the url to 'processed' pipeline
+			aa = g_processing_urls[url]
+			aa['uniqueId'] = uniqueId
+			aa['status'] = 'processed' #maintain the status for CSV 
+			if outfitUrls:
+				aa['outfitUrls'] = outfitUrls
+			if visit:
+				aa.update(visit)
+			g_processed_urls[url] = aa 
+			# remove it from the processing pipeline
+			g_processing_urls.pop(url, None)
+			g_dirty_urls.add(url)
 
 	#by this point, url has already been moved to processed pipeline
 
 
-# get the next url to process from the min heapq
+# puts a url that is processing or processed back in the new pipeline with its priority, keeping its revisit fields
+def requeueUrl(url):
+	with g_lock:
+		for pipeline in (g_processing_urls, g_processed_urls):
+			if url in pipeline:
+				aa = pipeline[url]
+				aa['status'] = 'new'
+				g_new_urls[url] = aa
+				pipeline.pop(url, None)
+				if g_frontier is None:
+					heapq.heappush(g_new_urls_heapq, (int(aa['priority']), url))
+				g_dirty_urls.add(url)
+				g_frontier_condition.notify_all()
+				return True
+	return False
+
+# the page of a url failed (exception, dead browser), put it back in the new pipeline for another session
+# after g_url_max_retries failures it is marked as processed so it cannot stall the crawl
+def retryUrl(url):
+	with g_lock:
+		#the failure happened after the url was processed
+		if url not in g_processing_urls:
+			return
+		aa = g_processing_urls[url]
+		aa['retries'] = int(aa.get('retries') or 0) + 1
+		if aa['retries'] > g_url_max_retries:
+			g_logger.warning('retryUrl() %s failed %d times, giving up', url, aa['retries'])
+			g_metrics.increment('urls_failed')
+			markUrlAsProcessed(url, 'FAILED', set())
+		else:
+			g_metrics.increment('url_retries')
+			requeueUrl(url)
+
+# revisit mode, requeues the processed urls whose next visit is due
+# the sqlite frontier filters the due urls in sql instead of decoding every processed url
+# they are collected before the requeue, which moves them out of the processed pipeline
+def scheduleRevisits():
+	deadline = time.time() + g_revisit_slack
+	if g_frontier is not None:
+		dueUrls = g_frontier.listDueUrls('processed', deadline)
+	else:
+		with g_lock:
+			dueUrls = [url for url, aa in g_processed_urls.items() if float(aa.get('lastVisit') or 0) + float(aa.get('revisitInterval') or 0) <= deadline]
+	count = 0
+	for url in dueUrls:
+		if requeueUrl(url):
+			count += 1
+	g_logger.debug('scheduleRevisits() %d urls due for a revisit', count)
+
+# fingerprint of the extracted fields of an item, used to detect the products that did not change since the last visit
+# image urls are compared without their query string which holds cache busting tokens
+def computeItemFingerprint(aa):
+	h = hashlib.sha1()
+	for key in g_fingerprint_fields:
+		value = aa.get(key, '')
+		if key == 'imageUrls':
+			value = [sanitizeUrl(imageUrl) for imageUrl in value]
+		if isinstance(value, list) or isinstance(value, set):
+			value = g_delimiter.join(sorted(value))
+		h.update(('%s=%s\n' % (key, value)).encode('utf-8'))
+	return h.hexdigest()
+
+# returns the revisit fields of the url after this visit
+# @urlAA = url dictionary with the fields of the previous visits
+# @fingerprint = fingerprint of the extracted item, '' for pages without item (catalog), they are revisited every g_revisit_interval
+# @validators = (etag, lastModified) of the http response, None when the page was rendered by the browser
+def getVisitFields(urlAA, fingerprint, validators):
+	previous = urlAA.get('fingerprint') or ''
+	visits = int(urlAA.get('visits') or 0) + 1
+	changes = int(urlAA.get('changes') or 0)
+	if previous and previous != fingerprint:
+		changes += 1
+
+	visit = {'fingerprint' : fingerprint, 'lastVisit' : int(time.time()), 'visits' : visits, 'changes' : changes}
+	if fingerprint:
+		visit['revisitInterval'] = int(min(g_revisit_max_interval, g_revisit_interval * (visits + 1) / float(changes + 1)))
+	else:
+		visit['revisitInterval'] = g_revisit_interval
+	if validators:
+		visit['etag'] = validators[0] or ''
+		visit['lastModified'] = validators[1] or ''
+	return visit
+
+# get the next url to process from the min heapq (or the priority index of the sqlite frontier)
 # removes a url from the 'new' pipeline and moves it to 'processing' pipeline 
 def getNextUrlToProcess():
 	url = ''
 
-	if g_new_urls_heapq:
-		tup = heapq.heappop(g_new_urls_heapq)
-		url = tup[1]
-		
-		if url in g_new_urls:
-			aa = g_new_urls[url]
-			aa['status'] = 'processing'
-			g_processing_urls[url] = aa
-			del g_new_urls[url]
-	else:
-		g_logger.warning('no new urls to process')
+	with g_lock:
+		while url == '':
+			candidate = popNewUrl()
+			if candidate == '':
+				break
+			
+			# skip the stale heap entries, another worker may have claimed the url already
+			if candidate in g_new_urls:
+				url = candidate
+				aa = g_new_urls[url]
+				aa['status'] = 'processing'
+				g_processing_urls[url] = aa
+				g_new_urls.pop(url, None)
+
+		#the idle workers poll every second, the drained frontier is reported once by crawlWithWorkers()
+		if url == '':
+			g_logger.debug('no new urls to process')
 	
 	return url
 
+# used by the crawl workers, blocks until a url can be claimed from the shared frontier
+# returns '' only when the frontier is empty AND no other worker is busy, i.e. no more urls can show up
+# @previousUrl = url this worker just finished, '' on the first call
+def claimNextUrlToProcess(previousUrl):
+	global g_active_workers
+
+	with g_frontier_condition:
+		if previousUrl != '':
+			releaseWorker()
+
+		while True:
+			url = getNextUrlToProcess()
+			if url != '':
+				g_active_workers += 1
+				return url
+			if g_active_workers == 0:
+				return ''
+			# links of the pages in flight have not been harvested yet, wait for them
+			g_frontier_condition.wait(1)
+
+# the worker is done with its url, wake up the idle workers so they can re-check the frontier
+def releaseWorker():
+	global g_active_workers
+
+	with g_frontier_condition:
+		g_active_workers -= 1
+		g_frontier_condition.notify_all()
+
 # return the priority of the url
 def getPriority(url):
 	aa = {}
-	if url in g_new_urls:
-		aa = g_new_urls[url]
-	elif url in g_processing_urls:
-		aa = g_processing_urls[url]
-	elif url in g_processed_urls:
-		aa = g_processed_urls[url]
+	with g_lock:
+		if url in g_new_urls:
+			aa = g_new_urls[url]
+		elif url in g_processing_urls:
+			aa = g_processing_urls[url]
+		elif url in g_processed_urls:
+			aa = g_processed_urls[url]
 
 	return int(aa['priority'])
 
@@ -175,12 +681,129 @@ def extractCetegoryFromUrl(url):
 			result = values[5]
 	return result
 
-#check if the domain matches any of the blacklisted domains
-def isBlacklistedDomain(url):
-	for domain in g_blacklist:
-		if url.find(domain) != -1:
-			return True
-	return False
+# builds the item dictionary stored in g_items from the raw text of the product page
+# shared by the webdriver and the plain http extraction so both produce exactly the same row
+# @url = product url, the category is taken from it
+# @itemName, @priceText = visible text of the name and price elements
+# @colorText, @descriptionText = textContent of the color and description divs
+# @imageSrcs = list of src attributes of the product images
+def buildItemFromFields(url, itemName, priceText, colorText, descriptionText, imageSrcs):
+	aa = {}
+	aa['itemName'] = itemName
+
+	#category of the product
+	aa['category'] = extractCetegoryFromUrl(url)
+
+	#price and revised price
+	priceArray = re.split('\$|\n', priceText)
+	aa['priceArray'] = set()
+	#if the string is a number - integer or float
+	for price in priceArray:
+		if re.match("^\d+?\.\d+?$", price) and price: 
+			aa['priceArray'].add(str(price))
+
+	#color
+	color = colorText.strip('\t\n') #strip unwated characters
+	colorArray = color.split(':')
+	if len(colorArray) > 1:
+		aa['color'] = colorArray[1].strip('\t\n')
+	#TODO : get the alternate color also
+	
+	#description & material and washing instructions
+	description = descriptionText.strip('\t\n') 
+	descriptionArray = description.split('\n')
+	strippedDescription = []
+	for description in descriptionArray:
+		text = description.strip('\t\n')
+		if text != '':
+			strippedDescription.append(text)
+
+	aa['description'] = g_delimiter.join(strippedDescription)
+
+	#extract image url
+	aa['imageUrls'] = set()
+	for attr in imageSrcs:
+		if attr:
+			aa['imageUrls'].add(attr)
+
+	#set top level url 
+	aa['url'] = url
+	return aa
+
+# adds the 'complete your outfit' links to the new urls with a higher priority than the other links of the page
+# returns the set of outfit urls, needed later to collect the outfit unique IDs
+def addOutfitUrlsToDictionary(url, outfitHrefs):
+	outfitUrls = set()
+	for href in filterHrefs(outfitHrefs):
+		print ('++++++++++++++', href)
+		addUrlToDictionary(href, {'priority' : getPriority(url) + 1}) #non outfit urls have priority lower than outfits
+		#keep the url the product is tracked under, so the outfit ids can be linked
+		outfitUrls.add(resolveUrl(href))
+	return outfitUrls
+
+# stores the extracted item and moves its url to the processed pipeline
+# an item whose fingerprint did not change since the last visit is left as is
+# @validators = (etag, lastModified) when the page was fetched over http
+def commitItem(url, uniqueId, aa, outfitUrls, validators=None):
+	#g_logger.debug("%s " % str (aa))
+	fingerprint = computeItemFingerprint(aa)
+	with g_lock:
+		urlAA = g_processing_urls[url] if url in g_processing_urls else {}
+		unchanged = urlAA.get('fingerprint') == fingerprint and uniqueId in g_items
+		if unchanged:
+			g_logger.debug('commitItem() %s did not change since the last visit', uniqueId)
+		else:
+			#the outfit ids are linked at the checkpoints, do not lose the ones collected so far
+			if uniqueId in g_items and 'outfitIds' in g_items[uniqueId]:
+				aa['outfitIds'] = g_items[uniqueId]['outfitIds']
+			g_items[uniqueId] = aa
+			g_dirty_items.add(uniqueId)
+
+		markUrlAsProcessed(url, uniqueId, outfitUrls, getVisitFields(urlAA, fingerprint, validators))	
+
+	#outside of the lock, a full queue blocks this worker only
+	if not unchanged:
+		enqueueItemImages(uniqueId, aa.get('imageUrls', set()))
+
+# reads the raw product fields one element at a time, every find_element/get_attribute/is_displayed is a round trip to the browser
+# returns a dictionary with the same keys as g_extract_features_script
+def extractProductFieldsWithWebElements(driver, uniqueIdElem):
+	fields = {'uniqueId' : uniqueIdElem.text}
+	#extract other features only if the unique id is found	
+	if fields['uniqueId'].find('REF') == -1:
+		return fields
+
+	#name of the product
+	fields['itemName'] = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[1]/div/div[1]/div[1]/h1").text
+
+	#price and revised price
+	fields['price'] = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[1]/div/div[2]/div").text
+
+	#color
+	fields['color'] = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[2]").get_attribute('textContent')
+	
+	#description & material and washing instructions
+	fields['description'] = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[7]").get_attribute('textContent')
+
+	#complete your outfit
+	completeYourOutfit = driver.find_element_by_css_selector("div.look.completa_look.accordion-body.in.collapse.span12")
+	#completeYourOutfit = driver.find_element_by_xpath("//*[@id='outfit_08']")
+	links = completeYourOutfit.find_elements_by_tag_name('a')
+	fields['outfitHrefs'] = [link.get_attribute('href') for link in links if link.is_displayed()]
+
+	#extract image url
+	imageDiv = driver.find_element_by_xpath("//*[@id='mainDivBody']/div/div[5]/div[2]")
+	images = imageDiv.find_elements_by_tag_name('img')
+	fields['imageSrcs'] = [image.get_attribute('src') for image in images]
+	return fields
+
+# reads all the raw product fields with a single execute_script round trip
+# raises NoSuchElementException like the webdriver path when an element is missing, so catalog pages still end up in the except branch
+def extractProductFieldsWithScript(driver):
+	fields = driver.execute_script(g_extract_features_script)
+	if fields is None:
+		raise NoSuchElementException('product element missing')
+	return fields
 
 # specific per retailer MANGO
 # @url to extract the features from
@@ -194,81 +817,20 @@ def extractFeatures(url, driver):
 	try:
 		result = False
 		wait = WebDriverWait(driver, 10)
-		uniqueIdElem = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, "div.referenciaProducto.row-fluid")))
+		with g_metrics.timer('wait'):
+			uniqueIdElem = wait.until(EC.visibility_of_element_located((By.CSS_SELECTOR, "div.referenciaProducto.row-fluid")))
 		#uniqueIdElem = driver.find_element_by_xpath('//*[@id="Form:SVFichaProducto:panelFicha"]/div[1]/div/div[1]/div[2]')
-		#extract other features only if the unique id is found	
-		if uniqueIdElem.text.find('REF') != -1:
-			aa = {}
-			uniqueId = uniqueIdElem.text
-
-			#name of the product
-			itemName = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[1]/div/div[1]/div[1]/h1")
-			aa['itemName'] = itemName.text
-
-			#category of the product
-			aa['category'] = extractCetegoryFromUrl(url)
-
-			#price and revised price
-			price = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[1]/div/div[2]/div")
-			priceArray = re.split('\$|\n', price.text)
-			aa['priceArray'] = set()
-			#if the string is a number - integer or float
-			for price in priceArray:
-				if re.match("^\d+?\.\d+?$", price) and price: 
-					aa['priceArray'].add(str(price))
-
-			#color
-			hiddenDiv = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[2]")
-			color = hiddenDiv.get_attribute('textContent')
-			color = color.strip('\t\n') #strip unwated characters
-			colorArray = color.split(':')
-			if len(colorArray) > 1:
-				aa['color'] = colorArray[1].strip('\t\n')
-			#TODO : get the alternate color also
-			
-			#description & material and washing instructions
-			hiddenDiv = driver.find_element_by_xpath("//*[@id='Form:SVFichaProducto:panelFicha']/div[7]")
-			description = hiddenDiv.get_attribute('textContent')
-			description = description.strip('\t\n') 
-			descriptionArray = description.split('\n')
-			strippedDescription = []
-			for description in descriptionArray:
-				text = description.strip('\t\n')
-				if text != '':
-					strippedDescription.append(text)
-
-			aa['description'] = g_delimiter.join(strippedDescription)
-
-			#complete your outfit
-			outfitUrls = set()
-			completeYourOutfit = driver.find_element_by_css_selector("div.look.completa_look.accordion-body.in.collapse.span12")
-			#completeYourOutfit = driver.find_element_by_xpath("//*[@id='outfit_08']")
-			links = completeYourOutfit.find_elements_by_tag_name('a')
-			for link in links:
-				if link.is_displayed():
-					href = sanitizeUrl(link.get_attribute('href'))
-					if href and href.find(g_domain) != -1 and not isBlacklistedDomain(href):
-						outfitUrls.add(href)
-						print ('++++++++++++++', href)
-						addUrlToDictionary(href, {'priority' : getPriority(url) + 1}) #non outfit urls have priority lower than outfits
-
-			#extract image url
-			imageDiv = driver.find_element_by_xpath("//*[@id='mainDivBody']/div/div[5]/div[2]")
-			images = imageDiv.find_elements_by_tag_name('img')
-
-			aa['imageUrls'] = set()
-			for image in images:
-				attr = image.get_attribute('src')
-				if attr:
-					aa['imageUrls'].add(attr)
-
-			#set top level url 
-			aa['url'] = url
-			
-			#g_logger.debug("%s " % str (aa))
-			g_items[uniqueId] = aa
+		with g_metrics.timer('extract'):
+			if g_single_script_extraction:
+				fields = extractProductFieldsWithScript(driver)
+			else:
+				fields = extractProductFieldsWithWebElements(driver, uniqueIdElem)
 
-			markUrlAsProcessed(url, uniqueId, outfitUrls)	
+		if fields['uniqueId'].find('REF') != -1:
+			aa = buildItemFromFields(url, fields['itemName'], fields['price'], fields['color'], fields['description'], fields['imageSrcs'])
+			with g_metrics.timer('link_harvest'):
+				outfitUrls = addOutfitUrlsToDictionary(url, fields['outfitHrefs'])
+			commitItem(url, fields['uniqueId'], aa, outfitUrls)
 			result = True
 
 		else:
@@ -276,15 +838,17 @@ def extractFeatures(url, driver):
 
 
 		#find all the links in the page and add them to g_urls AFTER the outfit urls have been added so their priority is maintained
-		allLinks = driver.find_elements_by_tag_name('a')
-		addMultipleUrlsToDictionary(url, allLinks)
+		with g_metrics.timer('link_harvest'):
+			addPageLinksToDictionary(url, driver)
 		return result
 
 	except:
 		#uniqe ID was not found on page, check if this is a product catalog page
 		g_logger.warning('uniqueId element not found in url %s', url)
 		take_screenshot(url, driver)
-		markUrlAsProcessed(url, 'NO_ITEM_FOUND', set())	
+		with g_lock:
+			urlAA = g_processing_urls[url] if url in g_processing_urls else {}
+			markUrlAsProcessed(url, 'NO_ITEM_FOUND', set(), getVisitFields(urlAA, '', None))	
 
 		button = driver.find_element_by_css_selector("#navColumns4")
 		# wait till product catalog or the unique id is visible //*[@id="productCatalog"]
@@ -295,33 +859,298 @@ def extractFeatures(url, driver):
 		driver.implicitly_wait(7) # seconds
 		#wait_for(link_has_gone_stale, button)
 
-		productCatalog = driver.find_element_by_xpath("//*[@id='productCatalog']")
-		products = set(productCatalog.find_elements_by_tag_name('a'))
-		loading = True
-		if products:
-			addMultipleUrlsToDictionary(url, products)
+		#the implicit wait above lets the catalog show up
+		driver.find_element_by_xpath("//*[@id='productCatalog']")
+		with g_metrics.timer('catalog_scroll'):
+			count = harvestCatalog(url, driver)
 
-		while products and loading: 
-			#products get dynamically loaded, so scroll to the bottom of the page#
-			driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")		
+		category = extractCetegoryFromUrl(url)
+		g_logger.debug('found %d items in category %s', count, category)
+		with g_lock:
+			g_item_count_per_category[category] = {'count' : count}
+			g_dirty_categories.add(category)
+
+# products of a catalog page get dynamically loaded, scroll to the bottom until the catalog stops growing
+# every round is one execute_async_script: scroll, wait for the DOM mutations to settle, return only the hrefs
+# of the anchors that were not harvested yet
+# returns the number of product anchors in the catalog
+def harvestCatalog(url, driver):
+	driver.set_script_timeout((g_catalog_first_mutation_timeout + g_catalog_max_round_time) / 1000.0 + 5)
+	seenHrefs = set()
+	count = 0
+	while True:
+		result = driver.execute_async_script(g_harvest_catalog_script, g_catalog_idle_time, g_catalog_first_mutation_timeout, g_catalog_max_round_time)
+		if result is None:
+			break
+		count = result['count']
+
+		newHrefs = [href for href in result['hrefs'] if href not in seenHrefs]
+		if newHrefs:
+			seenHrefs.update(newHrefs)
+			addMultipleHrefsToDictionary(url, newHrefs)
+
+		#no new anchor after the scroll, the catalog is fully loaded
+		if not result['hrefs']:
+			break
+	return count
+
+
+
+
+
+# returns the pooled http session of the calling worker
+def getHttpSession():
+	session = getattr(g_http_local, 'session', None)
+	if session is None:
+		session = requests.Session()
+		session.headers.update(g_http_headers)
+		adapter = HTTPAdapter(pool_connections=g_http_pool_size, pool_maxsize=g_http_pool_size)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		g_http_local.session = session
+	return session
+
+def getHostState(host):
+	if host not in g_host_state:
+		g_host_state[host] = {'rate' : g_host_initial_rate, 'concurrency' : float(g_host_initial_concurrency), 'active' : 0, 'nextSlot' : 0.0,
+			'backoffUntil' : 0.0, 'backoff' : 0.0, 'latency' : 0.0, 'errorRate' : 0.0, 'requests' : 0}
+	return g_host_state[host]
+
+# blocks until the host of the url accepts one more request
+# returns the host, to be given back to releaseHostSlot() once the page is loaded
+def acquireHostSlot(url):
+	host = urlparse(url).netloc
+	if not g_rate_limit:
+		return host
+
+	with g_host_condition:
+		state = getHostState(host)
+		while True:
+			now = time.time()
+			start = max(state['nextSlot'], state['backoffUntil'])
+			if state['active'] < int(state['concurrency']) and now >= start:
+				state['active'] += 1
+				state['nextSlot'] = max(now, state['nextSlot']) + 1.0 / state['rate']
+				return host
+			if state['active'] >= int(state['concurrency']):
+				g_host_condition.wait(1)
+			else:
+				g_host_condition.wait(start - now)
 
-			#give couple of seconds to load more items
-			time.sleep(2)
+# gives the slot back and adapts the rate and the concurrency of the host
+# @latency = time the request took in ms
+# @outcome = 'ok', 'error', 'timeout' or 'throttled'
+def releaseHostSlot(host, latency, outcome):
+	if not g_rate_limit:
+		return
 
-			newProducts = set(productCatalog.find_elements_by_tag_name('a'))
-			if newProducts and newProducts.difference(products):
-				addMultipleUrlsToDictionary(url, newProducts.difference(products))
-				products = products.union(newProducts)
-			else: 
-				loading = False
+	with g_host_condition:
+		state = getHostState(host)
+		state['active'] -= 1
+		state['requests'] += 1
+		state['latency'] = 0.8 * state['latency'] + 0.2 * latency if state['latency'] else latency
+		state['errorRate'] = 0.9 * state['errorRate'] + 0.1 * (0 if outcome == 'ok' else 1)
+
+		if outcome == 'ok' and latency <= g_host_latency_target:
+			#additive increase
+			state['rate'] = min(g_host_max_rate, state['rate'] + g_host_rate_increase)
+			state['concurrency'] = min(float(g_host_max_concurrency), state['concurrency'] + 1.0 / state['concurrency'])
+			state['backoff'] = 0.0
+		else:
+			#multiplicative decrease
+			state['rate'] = max(g_host_min_rate, state['rate'] * g_host_decrease_factor)
+			state['concurrency'] = max(1.0, state['concurrency'] * g_host_decrease_factor)
+			if outcome == 'throttled':
+				state['backoff'] = min(g_host_max_backoff, state['backoff'] * 2 if state['backoff'] else g_host_backoff)
+				state['backoffUntil'] = time.time() + state['backoff']
+			g_logger.warning('releaseHostSlot() %s for %s after %d ms, rate %.2f req/s, concurrency %d, backoff %ds, error rate %.2f',
+				outcome, host, latency, state['rate'], int(state['concurrency']), state['backoff'], state['errorRate'])
+		g_host_condition.notify_all()
+
+# paced http GET on the pooled session of the worker
+# @headers = extra request headers, e.g. the conditional headers of a revisit
+def fetchOverHttp(url, headers=None):
+	host = acquireHostSlot(url)
+	start = time.time()
+	outcome = 'error'
+	try:
+		r = getHttpSession().get(url, timeout=g_http_timeout, headers=headers)
+		outcome = 'throttled' if r.status_code in g_throttle_status_codes else 'ok'
+		return r
+	except requests.Timeout:
+		outcome = 'timeout'
+		raise
+	finally:
+		latency = (time.time() - start) * 1000
+		releaseHostSlot(host, latency, outcome)
+		g_metrics.observe('stage_latency', latency, stage='http_get')
+		if outcome != 'ok':
+			g_metrics.increment('load_failures', outcome=outcome)
+
+# paced driver.get, the browser does not expose the status code so throttling is detected from the page title
+# returns the load time in ms, without the time spent waiting for the slot
+def loadPageInBrowser(url, driver):
+	host = acquireHostSlot(url)
+	start = time.time()
+	outcome = 'error'
+	try:
+		driver.get(url)
+		outcome = 'ok'
+		if g_rate_limit:
+			title = driver.title
+			for marker in g_throttle_page_markers:
+				if title.find(marker) != -1:
+					outcome = 'throttled'
+	except TimeoutException:
+		outcome = 'timeout'
+		raise
+	finally:
+		loadTime = (time.time() - start) * 1000
+		releaseHostSlot(host, loadTime, outcome)
+		g_metrics.observe('stage_latency', loadTime, stage='driver_get')
+		if outcome != 'ok':
+			g_metrics.increment('load_failures', outcome=outcome)
+	return loadTime
+
+# css class test for lxml xpath, same semantic as the '.' of a css selector
+def xpathHasClass(className):
+	return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % className
+
+# inline display:none / visibility:hidden or the hidden attribute on the element itself
+def isHiddenNode(elem):
+	style = (elem.get('style') or '').replace(' ', '').lower()
+	return 'display:none' in style or 'visibility:hidden' in style or elem.get('hidden') is not None
+
+# lxml equivalent of the webdriver 'display' check, the element and all its parents must be visible
+def isHiddenInHtml(elem):
+	while elem is not None:
+		if isHiddenNode(elem):
+			return True
+		elem = elem.getparent()
+	return False
 
-		category = extractCetegoryFromUrl(url)
-		g_logger.debug('found %d items in category %s', len(products), category)
-		g_item_count_per_category[category] = {'count' : len(products)}
+g_block_tags = set(['address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'fieldset', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul'])
+
+# approximates the webdriver WebElement.text of an lxml element : block elements start a new line,
+# whitespace is collapsed, empty lines and hidden elements are dropped
+def getElementText(elem):
+	parts = []
+	hiddenDepth = 0
+	for event, node in lxml.etree.iterwalk(elem, events=('start', 'end')):
+		if not isinstance(node.tag, str):
+			#comments and processing instructions
+			if event == 'end' and node is not elem and node.tail and hiddenDepth == 0:
+				parts.append(node.tail)
+			continue
+		hidden = node is not elem and (node.tag in ('script', 'style') or isHiddenNode(node))
+		if event == 'start':
+			if hidden:
+				hiddenDepth += 1
+			if hiddenDepth == 0:
+				if node.tag in g_block_tags:
+					parts.append('\n')
+				if node.text:
+					parts.append(node.text)
+		else:
+			if hidden:
+				hiddenDepth -= 1
+			if hiddenDepth == 0:
+				if node.tag in g_block_tags:
+					parts.append('\n')
+				if node is not elem and node.tail:
+					parts.append(node.tail)
+
+	lines = [' '.join(line.split()) for line in ''.join(parts).split('\n')]
+	return '\n'.join([line for line in lines if line])
+
+# lxml version of the product branch of extractFeatures(), parses the server rendered html
+# returns (uniqueId, aa, outfitHrefs, allHrefs) or None when this is not a product page or a required field is missing
+# @url = url of the page, used to resolve the relative links
+# @html = page source
+def extractFeaturesFromHtml(url, html):
+	doc = lxml.html.fromstring(html)
+	doc.make_links_absolute(url)
+
+	uniqueIdElems = doc.xpath("//div[%s and %s]" % (xpathHasClass('referenciaProducto'), xpathHasClass('row-fluid')))
+	if not uniqueIdElems:
+		return None
+	uniqueId = getElementText(uniqueIdElems[0])
+	if uniqueId.find('REF') == -1:
+		return None
+
+	def firstElement(xpath):
+		elems = doc.xpath(xpath)
+		if elems:
+			return elems[0]
+		return None
+
+	itemName = firstElement("//*[@id='Form:SVFichaProducto:panelFicha']/div[1]/div/div[1]/div[1]/h1")
+	price = firstElement("//*[@id='Form:SVFichaProducto:panelFicha']/div[1]/div/div[2]/div")
+	colorDiv = firstElement("//*[@id='Form:SVFichaProducto:panelFicha']/div[2]")
+	descriptionDiv = firstElement("//*[@id='Form:SVFichaProducto:panelFicha']/div[7]")
+	imageDiv = firstElement("//*[@id='mainDivBody']/div/div[5]/div[2]")
+	completeYourOutfit = firstElement("//div[%s]" % ' and '.join([xpathHasClass(c) for c in ['look', 'completa_look', 'accordion-body', 'in', 'collapse', 'span12']]))
+	if itemName is None or price is None or colorDiv is None or descriptionDiv is None or imageDiv is None or completeYourOutfit is None:
+		return None
+
+	imageSrcs = [image.get('src') for image in imageDiv.iter('img')]
+	aa = buildItemFromFields(url, getElementText(itemName), getElementText(price), colorDiv.text_content(), descriptionDiv.text_content(), imageSrcs)
+	for field in g_http_required_fields:
+		if not aa.get(field):
+			g_logger.debug('extractFeaturesFromHtml() %s missing in the html of %s', field, url)
+			return None
+
+	outfitHrefs = [link.get('href') for link in completeYourOutfit.iter('a') if not isHiddenInHtml(link)]
+	allHrefs = doc.xpath('//a/@href')
+	return (uniqueId, aa, outfitHrefs, allHrefs)
+
+# plain http fast path, fetches the page with the pooled session and extracts the product without a browser
+# returns True when the url was fully processed, False when the caller has to fall back to the webdriver
+def extractFeaturesOverHttp(url):
+	if isUrlProcessed(url):
+		g_logger.debug('extractFeaturesOverHttp() %s already processed. Returning immedietly.', url)
+		return True
 
+	with g_lock:
+		urlAA = g_processing_urls[url] if url in g_processing_urls else {}
+	#light verification of a revisited product, the server answers 304 when the page did not change
+	headers = {}
+	if urlAA.get('fingerprint') and urlAA.get('uniqueId'):
+		if urlAA.get('etag'):
+			headers['If-None-Match'] = urlAA['etag']
+		if urlAA.get('lastModified'):
+			headers['If-Modified-Since'] = urlAA['lastModified']
 
+	try:
+		r = fetchOverHttp(url, headers)
+		if r.status_code == 304 and headers:
+			g_logger.debug('extractFeaturesOverHttp() %s not modified since the last visit', url)
+			recordPageLoad('http', len(r.content), 1, r.elapsed.total_seconds() * 1000)
+			with g_lock:
+				markUrlAsProcessed(url, urlAA['uniqueId'], None, getVisitFields(urlAA, urlAA['fingerprint'], (r.headers.get('ETag'), r.headers.get('Last-Modified'))))
+			return True
+		if r.status_code != 200:
+			g_logger.debug('extractFeaturesOverHttp() status %d for %s, fall back to webdriver', r.status_code, url)
+			return False
+		with g_metrics.timer('extract'):
+			result = extractFeaturesFromHtml(url, r.content)
+		if result is not None:
+			recordPageLoad('http', len(r.content), 1, r.elapsed.total_seconds() * 1000)
+	except:
+		g_logger.exception('extractFeaturesOverHttp() failed for %s, fall back to webdriver', url)
+		return False
 
+	if result is None:
+		return False
 
+	uniqueId, aa, outfitHrefs, allHrefs = result
+	with g_metrics.timer('link_harvest'):
+		outfitUrls = addOutfitUrlsToDictionary(url, outfitHrefs)
+	commitItem(url, uniqueId, aa, outfitUrls, (r.headers.get('ETag'), r.headers.get('Last-Modified')))
+	#add all the links AFTER the outfit urls so their priority is maintained
+	with g_metrics.timer('link_harvest'):
+		addMultipleHrefsToDictionary(url, allHrefs)
+	return True
 
 def take_screenshot(url, driver):
 	o = urlparse(url)
@@ -353,10 +1182,11 @@ def link_has_gone_stale(seleniumWebelement):
 def appendOutfitId(itemId, outfitId):
 	if itemId in g_items:
 		itemAA = g_items[itemId]
-		if 'outfitIds' not in itemAA:
-			itemAA['outfitIds'] = set()
-		itemAA['outfitIds'].add(outfitId)
-		g_items[itemId] = itemAA
+		#the item store returns a copy of the set, write it back
+		outfitIds = itemAA.get('outfitIds', set())
+		outfitIds.add(outfitId)
+		itemAA['outfitIds'] = outfitIds
+		g_dirty_items.add(itemId)
 
 def updateOutfitUniqueId(url, outfitUrl):
 	if url in g_processed_urls and outfitUrl in g_processed_urls:
@@ -368,14 +1198,58 @@ def updateOutfitUniqueId(url, outfitUrl):
 			appendOutfitId(itemId, outfitId)
 			appendOutfitId(outfitId, itemId)
 
+# links the outfit unique IDs of a newly processed url, both with the outfit urls it lists and with the
+# already processed urls that listed it, so every checkpoint only touches the urls processed since the last one
+def linkOutfitUrls(url):
+	if url not in g_processed_urls:
+		return
+	urlAA = g_processed_urls[url]
+	if 'outfitUrls' in urlAA:
+		for outfitUrl in urlAA['outfitUrls']:
+			outfitUrl = resolveUrl(outfitUrl)
+			if outfitUrl in g_processed_urls:
+				updateOutfitUniqueId(url, outfitUrl)
+			elif outfitUrl:
+				g_pending_outfit_urls.setdefault(outfitUrl, set()).add(url)
+				g_dirty_pending_outfit_urls.add(outfitUrl)
+
+	if url in g_pending_outfit_urls:
+		g_dirty_pending_outfit_urls.add(url)
+		for referrer in g_pending_outfit_urls.pop(url):
+			updateOutfitUniqueId(referrer, url)
+
 #load new url
 def loadUrlAndExtractData(url, driver):
 	g_logger.debug('loadUrlAndExtractData() %d, %s', getPriority(url),  url)
 	# implicit wait will make the webdriver to poll DOM for x seconds when the element
 	# is not available immedietly
 	#driver.implicitly_wait(7) # seconds
-	driver.get(url)
-	extractFeatures(url, driver)
+	with g_metrics.timer('page'):
+		#only the product pages are server rendered, the catalog pages go straight to the browser
+		if g_http_fast_path and extractProductId(url) and extractFeaturesOverHttp(url):
+			return
+		loadTime = loadPageInBrowser(url, driver)
+		result = extractFeatures(url, driver)
+
+		# measured after the extraction so the catalog scroll is included in the bytes
+		stats = driver.execute_script(g_page_stats_script)
+		recordPageLoad('product' if result else 'catalog', stats['bytes'], stats['resources'], loadTime)
+	g_logger.debug('loadUrlAndExtractData() %d bytes, %d resources, %d ms for %s', stats['bytes'], stats['resources'], loadTime, url)
+
+# accumulates the bytes and the load time per page type in g_metrics, logged at every checkpoint by logPageLoadStats()
+# @pageType = 'product', 'catalog' or 'http' for the pages fully handled by the http fast path
+def recordPageLoad(pageType, bytes, resources, loadTime):
+	g_metrics.increment('page_loads', type=pageType)
+	g_metrics.increment('page_bytes', bytes, type=pageType)
+	g_metrics.increment('page_resources', resources, type=pageType)
+	g_metrics.observe('page_load_latency', loadTime, type=pageType)
+
+def logPageLoadStats():
+	for pageType in g_metrics.getLabelValues('page_loads', 'type'):
+		pages = g_metrics.getCounter('page_loads', type=pageType)
+		latency = g_metrics.getHistogram('page_load_latency', type=pageType)
+		g_logger.info('page load %s : %d pages, avg %d bytes, avg %.1f resources, avg %d ms', pageType, pages, g_metrics.getCounter('page_bytes', type=pageType) / pages,
+			g_metrics.getCounter('page_resources', type=pageType) / float(pages), latency['avg'])
 
 
 #converts python internal data structure to appropriate format
@@ -403,7 +1277,8 @@ def sanitizeCSVRow(row):
 	while row:
 		key, value = row.popitem(False)
 		if key == 'imageUrls' or key == 'priceArray' or key == 'outfitIds' or key == 'outfitUrls':
-			aa[key] = set(value.split(g_delimiter))
+			#the parquet rows already hold lists
+			aa[key] = set(value) if isinstance(value, list) else set(value.split(g_delimiter))
 		else:
 			aa[key] = value
 
@@ -421,7 +1296,16 @@ def convertRowToAA(row):
 			url = value
 			# add the urls in processed pipeline
 			if aa['status'] == 'processed':
+				# a journal record can move a url that the snapshot still had in the new pipeline
+				# its heapq entry becomes stale and is skipped by getNextUrlToProcess()
+				g_new_urls.pop(url, None)
+				g_processing_urls.pop(url, None)
 				g_processed_urls[url] = aa
+				productId = extractProductId(url)
+				if productId:
+					setProductUrl(productId, url)
+			elif aa['status'] == 'alias':
+				g_alias_urls[url] = aa
 			else:
 				addUrlToDictionary(url, aa)
 		elif key == 'uniqueId':
@@ -463,32 +1347,456 @@ def readCSVToDict(csvFile):
 			with open(csvFile) as csvfile:
 				reader = csv.DictReader(csvfile)
 				for row in reader:
-					convertRowToAA(row)
+					#DictReader returns a plain dict since python 3.8, convertRowToAA() needs the FIFO popitem
+					convertRowToAA(OrderedDict(row))
 
 		except IOError:
 			g_logger.error("I/O error({0}): {1}".format(errno, strerror))
 		return
 
-def saveSessionOutput():
-	g_logger.debug('Save session')
-	for url in g_processed_urls:
-		urlAA = g_processed_urls[url]
-		if 'outfitUrls' in urlAA: 
-			outfitUrls = urlAA['outfitUrls']
-			for newUrl in outfitUrls:
-				updateOutfitUniqueId(url, newUrl)
-
+# loads the parquet copy of the csv when it is up to date, the csv otherwise
+def readTableToDict(csvFile):
+	parquetFile = columnarStore.getFreshParquetPath(csvFile) if g_parquet_output else None
+	if parquetFile is None:
+		readCSVToDict(csvFile)
+		return
+	for row in columnarStore.readParquetRows(parquetFile):
+		convertRowToAA(row)
 
-	#save the output of this session in csv
+def setPendingOutfitUrl(outfitUrl, referrers):
+	if referrers:
+		g_pending_outfit_urls[outfitUrl] = set(referrers)
+	else:
+		g_pending_outfit_urls.pop(outfitUrl, None)
+
+# one row per pending outfit url, its referrers joined with g_delimiter
+def writePendingOutfitUrlsToCSV(csvFile):
+	with open(csvFile, 'w') as csvfile:
+		writer = csv.writer(csvfile)
+		writer.writerow(['outfitUrl', 'referrers'])
+		for outfitUrl, referrers in g_pending_outfit_urls.items():
+			writer.writerow([outfitUrl, g_delimiter.join(sorted(referrers))])
+
+# returns False when the file is missing, the session was saved before the pending outfit urls had their own file
+def readPendingOutfitUrlsCSV(csvFile):
+	if not os.path.exists(csvFile):
+		return False
+	with open(csvFile) as csvfile:
+		for row in csv.DictReader(csvfile):
+			setPendingOutfitUrl(row['outfitUrl'], row['referrers'].split(g_delimiter) if row['referrers'] else [])
+	return True
+
+def getJournalPath():
+	path = os.getcwd() + g_journal_file_path
+	if g_journal_compress:
+		path += '.gz'
+	return path
+
+# appends the current value of every dirty url, item and category to the journal
+# the rows are in the csv format so the replay goes through convertRowToAA() like the snapshot
+# one write and one fsync per checkpoint
+def writeJournal():
+	records = []
+	#the sqlite frontier is already on disk
+	for url in (g_dirty_urls if g_frontier is None else []):
+		for pipeline in (g_new_urls, g_processing_urls, g_processed_urls, g_alias_urls):
+			if url in pipeline:
+				records.append({'table' : 'urls', 'row' : convertAAtoRow(url, pipeline[url])})
+				break
+	for uniqueId in g_dirty_items:
+		if uniqueId in g_items:
+			records.append({'table' : 'items', 'row' : convertAAtoRow(uniqueId, g_items[uniqueId])})
+	for category in g_dirty_categories:
+		if category in g_item_count_per_category:
+			records.append({'table' : 'itemsCount', 'row' : convertAAtoRow(category, g_item_count_per_category[category])})
+	#an outfit url without referrers is no longer pending
+	for outfitUrl in g_dirty_pending_outfit_urls:
+		records.append({'table' : 'pendingOutfitUrls', 'row' : {'outfitUrl' : outfitUrl, 'referrers' : sorted(g_pending_outfit_urls.get(outfitUrl, []))}})
+
+	if records:
+		data = ''.join([json.dumps(record) + '\n' for record in records]).encode('utf-8')
+		if g_journal_compress:
+			data = gzip.compress(data)
+		with open(getJournalPath(), 'ab') as fp:
+			fp.write(data)
+			fp.flush()
+			os.fsync(fp.fileno())
+	g_logger.debug('writeJournal() %d records', len(records))
+
+def clearDirtyKeys():
+	g_dirty_urls.clear()
+	g_dirty_items.clear()
+	g_dirty_categories.clear()
+	g_dirty_pending_outfit_urls.clear()
+
+# replays the journal left by the previous session on top of the csv snapshot
+# a torn record at the end (crash in the middle of a checkpoint) stops the replay
+# returns True when a journal was truncated, the records appended after the torn one would never be replayed
+# so the caller must rewrite the snapshot and drop the journal
+def replayJournal():
+	columns = {'urls' : g_urls_column, 'items' : g_items_column, 'itemsCount' : ['category', 'count']}
+	count = 0
+	truncated = False
+	for path in [os.getcwd() + g_journal_file_path, os.getcwd() + g_journal_file_path + '.gz']:
+		if not os.path.exists(path):
+			continue
+		try:
+			if path.endswith('.gz'):
+				fp = gzip.open(path, 'rt')
+			else:
+				fp = open(path)
+			with fp:
+				for line in fp:
+					record = json.loads(line)
+					row = record['row']
+					if record['table'] == 'pendingOutfitUrls':
+						setPendingOutfitUrl(row['outfitUrl'], row['referrers'])
+						count += 1
+						continue
+					convertRowToAA(OrderedDict([(column, str(row[column]) if column in row else '') for column in columns[record['table']]]))
+					count += 1
+		except (ValueError, EOFError, OSError):
+			g_logger.warning('replayJournal() %s is truncated, replayed %d records', path, count)
+			truncated = True
+	g_logger.debug('replayJournal() replayed %d records', count)
+	return truncated
+
+# rewrites the complete csv snapshot and drops the journal
+# each file is written next to the target and renamed so a crash never leaves a half written snapshot
+def compactSessionOutput():
 	currentPath = os.getcwd()
 	urlsCSVPath = currentPath + g_urls_csv_file_path 
 	itemCSVPath = currentPath + g_items_csv_file_path
 	itemCountCSVPath = currentPath + g_item_count_csv_file_path
-	writeDictToCSV(urlsCSVPath, g_urls_column, g_new_urls)
-	appendDictToCSV(urlsCSVPath, g_urls_column, g_processing_urls)
-	appendDictToCSV(urlsCSVPath, g_urls_column, g_processed_urls)
-	writeDictToCSV(itemCSVPath, g_items_column, g_items)
-	writeDictToCSV(itemCountCSVPath, ['category', 'count'], g_item_count_per_category)
+	#the sqlite frontier is its own snapshot, urls.csv is only written by the memory frontier
+	if g_frontier is None:
+		writeDictToCSV(urlsCSVPath + '.tmp', g_urls_column, g_new_urls)
+		appendDictToCSV(urlsCSVPath + '.tmp', g_urls_column, g_processing_urls)
+		appendDictToCSV(urlsCSVPath + '.tmp', g_urls_column, g_processed_urls)
+		appendDictToCSV(urlsCSVPath + '.tmp', g_urls_column, g_alias_urls)
+		os.replace(urlsCSVPath + '.tmp', urlsCSVPath)
+	writeDictToCSV(itemCSVPath + '.tmp', g_items_column, g_items)
+	writeDictToCSV(itemCountCSVPath + '.tmp', ['category', 'count'], g_item_count_per_category)
+	os.replace(itemCSVPath + '.tmp', itemCSVPath)
+	os.replace(itemCountCSVPath + '.tmp', itemCountCSVPath)
+	writePendingOutfitUrlsToCSV(currentPath + g_pending_outfit_urls_csv_file_path + '.tmp')
+	os.replace(currentPath + g_pending_outfit_urls_csv_file_path + '.tmp', currentPath + g_pending_outfit_urls_csv_file_path)
+	#written after the csv files, an older parquet file is ignored by readTableToDict()
+	if g_parquet_output:
+		if g_frontier is None:
+			urls = itertools.chain(g_new_urls.items(), g_processing_urls.items(), g_processed_urls.items(), g_alias_urls.items())
+			columnarStore.writeDictToParquet(columnarStore.getParquetPath(urlsCSVPath), g_urls_column, urls, g_delimiter)
+		columnarStore.writeDictToParquet(columnarStore.getParquetPath(itemCSVPath), g_items_column, g_items.items(), g_delimiter)
+		columnarStore.writeDictToParquet(columnarStore.getParquetPath(itemCountCSVPath), ['category', 'count'], g_item_count_per_category.items(), g_delimiter)
+
+	#the snapshot now contains everything the journal had
+	for path in [currentPath + g_journal_file_path, currentPath + g_journal_file_path + '.gz']:
+		if os.path.exists(path):
+			os.remove(path)
+
+# checkpoint, appends the changes since the last checkpoint to the journal
+# every g_journal_compaction_interval checkpoints (or when compact is True) the csv snapshot is rewritten instead
+def saveSessionOutput(compact=False):
+	global g_checkpoints_since_compaction
+
+	g_logger.debug('Save session')
+	# hold the lock for the whole checkpoint, the workers must not mutate the dictionaries while they are written
+	with g_lock, g_metrics.timer('save_session'):
+		for url in list(g_dirty_urls):
+			linkOutfitUrls(url)
+
+		g_checkpoints_since_compaction += 1
+		if compact or g_checkpoints_since_compaction >= g_journal_compaction_interval:
+			g_checkpoints_since_compaction = 0
+			compactSessionOutput()
+		else:
+			writeJournal()
+		clearDirtyKeys()
+		logPageLoadStats()
+
+# count the page and save the session every g_save_session_interval pages, shared by all the workers
+def countProcessedPage():
+	global g_pages_since_save
+
+	g_metrics.increment('pages')
+	with g_lock:
+		g_pages_since_save += 1
+		if g_pages_since_save > g_save_session_interval:
+			g_pages_since_save = 0
+			saveSessionOutput()
+
+# switches the url pipelines to the sqlite frontier when g_frontier_backend is 'sqlite'
+# returns False when the frontier was reopened with urls in it, the urls csv must not be loaded again then
+def openFrontier():
+	global g_frontier, g_new_urls, g_processing_urls, g_processed_urls, g_alias_urls, g_new_urls_heapq
+
+	if g_frontier_backend != 'sqlite':
+		return True
+
+	seedUrls = list(g_new_urls.items())
+	g_frontier = crawlFrontier.SqliteFrontier(os.getcwd() + g_frontier_db_file_path, cacheSize=g_frontier_cache_size)
+	g_new_urls = g_frontier.pipeline('new')
+	g_processing_urls = g_frontier.pipeline('processing')
+	g_processed_urls = g_frontier.pipeline('processed')
+	g_alias_urls = g_frontier.pipeline('alias')
+	g_new_urls_heapq = []
+
+	requeued = g_frontier.requeueProcessing()
+	isEmpty = len(g_new_urls) == 0 and len(g_processed_urls) == 0
+	g_logger.debug('openFrontier() %s, %d new, %d processed, %d requeued', g_frontier_db_file_path, len(g_new_urls), len(g_processed_urls), requeued)
+	addUrlsToDictionary(seedUrls)
+	return isEmpty
+
+def closeFrontier():
+	if g_frontier is not None:
+		g_frontier.close()
+
+def createChromeOptions():
+	chrome_options = webdriver.ChromeOptions()  
+	chrome_options.add_argument("--headless")  
+	chrome_options.add_argument("--window-size=1920,1080");
+	chrome_options.binary_location = '/usr/bin/google-chrome-stable'    
+	if g_block_resources:
+		chrome_options.set_capability('pageLoadStrategy', g_page_load_strategy)
+		if 'image' in g_blocked_resource_types:
+			# no image decoding at all, the img src attributes are still in the DOM
+			chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+			chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images' : 2})
+	return chrome_options
+
+# url patterns blocked by the lean page load profile
+def getBlockedUrlPatterns():
+	patterns = list(g_blocked_url_patterns)
+	for resourceType in g_blocked_resource_types:
+		patterns.extend(g_resource_type_url_patterns.get(resourceType, []))
+	return patterns
+
+def createDriver(chrome_options):
+	driver = webdriver.Chrome(executable_path=os.path.abspath('/usr/local/bin/chromedriver'), chrome_options=chrome_options)
+	driver.set_page_load_timeout(g_page_load_timeout)
+	if g_block_resources:
+		driver.execute_cdp_cmd('Network.enable', {})
+		driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls' : getBlockedUrlPatterns()})
+	return driver
+
+def quitDriver(driver):
+	try:
+		driver.quit()
+	except:
+		g_logger.exception('quitDriver() failed')
+
+def isDriverHealthy(driver):
+	try:
+		return driver.execute_script('return 1') == 1
+	except:
+		return False
+
+# resident memory in MB of a process and all its descendants, 0 when /proc is not available
+def getProcessTreeRss(pid):
+	if not os.path.exists('/proc'):
+		return 0
+	children = {}
+	for entry in os.listdir('/proc'):
+		if entry.isdigit():
+			try:
+				with open('/proc/%s/stat' % entry) as fp:
+					#the process name can hold spaces, the fields after it are space separated
+					ppid = int(fp.read().rsplit(')', 1)[1].split()[1])
+				children.setdefault(ppid, []).append(int(entry))
+			except (IOError, ValueError, IndexError):
+				pass
+
+	total = 0
+	pids = [pid]
+	while pids:
+		current = pids.pop()
+		try:
+			with open('/proc/%d/status' % current) as fp:
+				for line in fp:
+					if line.startswith('VmRSS:'):
+						total += int(line.split()[1])
+		except (IOError, ValueError):
+			pass
+		pids.extend(children.get(current, []))
+	return total / 1024
+
+def getDriverRss(driver):
+	try:
+		return getProcessTreeRss(driver.service.process.pid)
+	except AttributeError:
+		return 0
+
+# starts sessions in the background until g_driver_standby of them are ready or starting
+def replenishStandbyDrivers(chrome_options):
+	global g_standby_pending
+
+	with g_standby_lock:
+		missing = g_driver_standby - g_standby_drivers.qsize() - g_standby_pending
+		g_standby_pending += max(0, missing)
+	for i in range(missing):
+		threading.Thread(target=startStandbyDriver, args=(chrome_options,), daemon=True).start()
+
+def startStandbyDriver(chrome_options):
+	global g_standby_pending
+
+	try:
+		g_standby_drivers.put(createDriver(chrome_options))
+	except:
+		g_logger.exception('startStandbyDriver() failed')
+	finally:
+		with g_standby_lock:
+			g_standby_pending -= 1
+
+# returns a healthy session, a warm standby one when available, and starts a new standby session in the background
+def acquireDriver(chrome_options):
+	driver = None
+	while driver is None:
+		try:
+			driver = g_standby_drivers.get_nowait()
+		except queue.Empty:
+			break
+		if not isDriverHealthy(driver):
+			g_logger.warning('acquireDriver() standby session is dead, dropping it')
+			threading.Thread(target=quitDriver, args=(driver,), daemon=True).start()
+			driver = None
+
+	if driver is None:
+		g_logger.debug('acquireDriver() no warm session ready, cold start')
+		g_metrics.increment('driver_cold_starts')
+		with g_metrics.timer('driver_start'):
+			driver = createDriver(chrome_options)
+	replenishStandbyDrivers(chrome_options)
+	return driver
+
+# quits a session in the background, quitting chrome takes as long as starting it
+def releaseDriver(driver):
+	threading.Thread(target=quitDriver, args=(driver,), daemon=True).start()
+
+def shutdownStandbyDrivers():
+	while True:
+		try:
+			quitDriver(g_standby_drivers.get_nowait())
+		except queue.Empty:
+			return
+
+# True when the session served its g_driver_max_pages pages or grew above g_driver_max_rss
+def shouldRecycleDriver(driver, pages):
+	if pages >= g_driver_max_pages:
+		return True
+	if g_driver_max_rss and pages % g_driver_rss_check_interval == 0:
+		rss = getDriverRss(driver)
+		if rss > g_driver_max_rss:
+			g_logger.debug('shouldRecycleDriver() chrome uses %d MB', rss)
+			return True
+	return False
+
+# one worker drives its own webdriver session and pulls urls from the shared frontier until it is exhausted
+# a failing url is requeued and the session is swapped for a warm one, the session is also health checked
+# between pages and recycled after g_driver_max_pages pages or above g_driver_max_rss MB
+# @workerId = used in the log lines only
+def crawlWorker(workerId, chrome_options):
+	g_logger.debug('crawlWorker() %d started', workerId)
+	driver = acquireDriver(chrome_options)
+	pages = 0
+	url = claimNextUrlToProcess('')
+	try:
+		while (url != ''):
+			try:
+				loadUrlAndExtractData(url, driver)
+				countProcessedPage()
+				pages += 1
+				swap = shouldRecycleDriver(driver, pages) or not isDriverHealthy(driver)
+			except:
+				g_logger.exception('worker %d caught exception for %s, swap driver session', workerId, url)
+				g_metrics.increment('page_failures')
+				retryUrl(url)
+				swap = True
+
+			if swap:
+				g_logger.debug('crawlWorker() %d swapping driver session after %d pages', workerId, pages)
+				g_metrics.increment('driver_restarts')
+				releaseDriver(driver)
+				driver = acquireDriver(chrome_options)
+				pages = 0
+			url = claimNextUrlToProcess(url)
+	finally:
+		if url != '':
+			# the worker died with a url in flight, do not keep the others waiting for it
+			retryUrl(url)
+			releaseWorker()
+		quitDriver(driver)
+		g_logger.debug('crawlWorker() %d finished', workerId)
+
+# registers the frontier gauges and starts the metrics endpoint and the periodic summary line
+def startMetrics():
+	g_metrics.setGauge('frontier_new_urls', lambda: len(g_new_urls))
+	g_metrics.setGauge('frontier_processing_urls', lambda: len(g_processing_urls))
+	g_metrics.setGauge('frontier_processed_urls', lambda: len(g_processed_urls))
+	g_metrics.setGauge('active_workers', lambda: g_active_workers)
+	g_metrics.setGauge('items', lambda: len(g_items))
+	if g_metrics_port:
+		server = crawlMetrics.startMetricsServer(g_metrics, g_metrics_port)
+		g_logger.info('metrics served on http://%s:%d/metrics', *server.server_address)
+	if g_metrics_summary_interval:
+		crawlMetrics.startSummaryLogger(g_metrics, g_metrics_summary_interval, g_logger.info)
+
+# queues an item for the image download threads, blocks while the queue is full
+def enqueueItemImages(uniqueId, imageUrls):
+	if g_image_queue is not None and imageUrls:
+		g_image_queue.put((uniqueId, list(imageUrls)))
+
+def imageDownloadWorker():
+	while True:
+		entry = g_image_queue.get()
+		if entry is None:
+			return
+		uniqueId, imageUrls = entry
+		try:
+			with g_metrics.timer('image_download'):
+				result = imageDownloader.downloadItemImages(uniqueId, imageUrls)
+			g_metrics.increment('image_items', status='complete' if result else 'failed')
+		except:
+			g_logger.exception('imageDownloadWorker() failed for %s', uniqueId)
+			g_metrics.increment('image_items', status='failed')
+
+# items of the previous sessions, their images complete in the manifest are skipped without a request
+def feedKnownItemImages(items):
+	for uniqueId, imageUrls in items:
+		enqueueItemImages(uniqueId, imageUrls)
+
+# starts the image download threads, imageDownloader.py is only needed in this mode
+def startImagePipeline():
+	global imageDownloader, g_image_queue, g_image_feeder
+
+	import imageDownloader
+	imageDownloader.g_download_workers = g_image_workers
+	imageDownloader.openManifest()
+	os.makedirs(os.getcwd() + imageDownloader.g_image_store_path + 'downloads/', exist_ok=True)
+	g_image_queue = queue.Queue(g_image_queue_size)
+	g_metrics.setGauge('image_queue_size', lambda: g_image_queue.qsize())
+	for i in range(g_image_workers):
+		t = threading.Thread(target=imageDownloadWorker, daemon=True)
+		t.start()
+		g_image_threads.append(t)
+
+	with g_lock:
+		items = [(uniqueId, aa.get('imageUrls', set())) for uniqueId, aa in g_items.items()]
+	g_image_feeder = threading.Thread(target=feedKnownItemImages, args=(items,), daemon=True)
+	g_image_feeder.start()
+
+# @drain = wait for the queued items, False on an interrupted crawl, the next session queues them again
+def stopImagePipeline(drain):
+	if g_image_queue is None:
+		return
+	if drain:
+		while g_image_feeder.is_alive():
+			g_image_feeder.join(1)
+		for t in g_image_threads:
+			g_image_queue.put(None)
+		for t in g_image_threads:
+			while t.is_alive():
+				t.join(1)
+	imageDownloader.closeManifest()
 
 def main():
 	currentPath = os.getcwd()
@@ -498,43 +1806,102 @@ def main():
 
 
 	#load the csv as dictionary	
-	readCSVToDict(urlsCSVPath)
-	readCSVToDict(itemCSVPath)
-	readCSVToDict(itemCountCSVPath)
+	if openFrontier():
+		readTableToDict(urlsCSVPath)
+	readTableToDict(itemCSVPath)
+	readTableToDict(itemCountCSVPath)
+	pendingOutfitUrlsSaved = readPendingOutfitUrlsCSV(currentPath + g_pending_outfit_urls_csv_file_path)
+	truncatedJournal = replayJournal()
+	#the module level seed url is not indexed yet
+	if g_frontier is None:
+		for url in list(g_new_urls):
+			if extractProductId(url):
+				setProductUrl(extractProductId(url), url)
+	#the links between processed urls were made by the checkpoints, only an older session without the pending
+	#outfit urls file needs them rebuilt, once, streaming the processed urls instead of listing them
+	if not pendingOutfitUrlsSaved:
+		for url in g_processed_urls:
+			linkOutfitUrls(url)
+	#the checkpoints of this session must not be appended after the torn record
+	if truncatedJournal or not pendingOutfitUrlsSaved:
+		compactSessionOutput()
+	#everything loaded so far is already on disk
+	clearDirtyKeys()
+	if g_revisit:
+		scheduleRevisits()
 
 	#print ("DEBUG %s " % str (g_new_urls))
 	#print ("DEBUG %s " % str (g_items))
-	url = getNextUrlToProcess()
-	chrome_options = webdriver.ChromeOptions()  
-	chrome_options.add_argument("--headless")  
-	chrome_options.add_argument("--window-size=1920,1080");
-	chrome_options.binary_location = '/usr/bin/google-chrome-stable'    
-	driver = webdriver.Chrome(executable_path=os.path.abspath('/usr/local/bin/chromedriver'), chrome_options=chrome_options)
+	startMetrics()
+	if g_download_images:
+		startImagePipeline()
+	chrome_options = createChromeOptions()
 
-	count = 1
-	while (url != ''):
-		try:
-			loadUrlAndExtractData(url, driver)
-			url = getNextUrlToProcess()
-			count += 1
-			if count > 20:
-				count = 0
-				saveSessionOutput()
-		except:
-			g_logger.exception('caught exception for %s, restart driver session', url)
-			driver.quit()
-			driver = webdriver.Chrome(executable_path=os.path.abspath('/usr/local/bin/chromedriver'), chrome_options=chrome_options)
+	try:
+		crawlWithWorkers(chrome_options)
+	except:
+		stopImagePipeline(False)
+		raise
+	finally:
+		shutdownStandbyDrivers()
+	g_logger.debug('crawl finished, waiting for the image downloads')
+	stopImagePipeline(True)
+
+def crawlWithWorkers(chrome_options):
+	if g_workers <= 1:
+		crawlWorker(0, chrome_options)
+		g_logger.warning('no new urls to process')
+		return
+
+	# every worker owns a browser, they only share the frontier and the output dictionaries
+	workers = []
+	for workerId in range(g_workers):
+		t = threading.Thread(target=crawlWorker, args=(workerId, chrome_options), daemon=True)
+		t.start()
+		workers.append(t)
+
+	# join with a timeout so that a keyboard interrupt still reaches the main thread
+	for t in workers:
+		while t.is_alive():
+			t.join(1)
+	g_logger.warning('no new urls to process')
 
 
 #main function
 #python lets you use the same source file as a reusable module or standalone
 #when python runs it as standalone, it sends __name__ with value "__main__"
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='crawl shop.mango.com and save the items in csv')
+	parser.add_argument('--workers', type=int, default=g_workers, help='number of concurrent webdriver sessions')
+	parser.add_argument('--no-http-fast-path', action='store_true', help='always render the pages in the browser')
+	parser.add_argument('--element-extraction', action='store_true', help='read the product fields element by element instead of with one script')
+	parser.add_argument('--no-block-resources', action='store_true', help='load every resource of the pages, with the normal page load strategy')
+	parser.add_argument('--no-rate-limit', action='store_true', help='do not pace the requests per host')
+	parser.add_argument('--revisit', action='store_true', help='recrawl the processed urls that are due, skipping the unchanged products')
+	parser.add_argument('--frontier', choices=['memory', 'sqlite'], default=g_frontier_backend, help='where the url pipelines are kept')
+	parser.add_argument('--metrics-port', type=int, default=g_metrics_port, help='serve /metrics and /metrics.json on this local port')
+	parser.add_argument('--download-images', action='store_true', help='download the images of the items while crawling')
+	parser.add_argument('--parquet', action='store_true', help='also save the session as parquet files and load them when they are up to date')
+	args = parser.parse_args()
+	g_workers = args.workers
+	g_http_fast_path = not args.no_http_fast_path
+	g_frontier_backend = args.frontier
+	g_single_script_extraction = not args.element_extraction
+	g_block_resources = not args.no_block_resources
+	g_rate_limit = not args.no_rate_limit
+	g_revisit = args.revisit
+	g_metrics_port = args.metrics_port
+	g_download_images = args.download_images
+	g_parquet_output = args.parquet
+	if g_parquet_output and not columnarStore.isAvailable():
+		parser.error('--parquet needs pyarrow')
 	
 	try:
 		main()
 		g_logger.debug('Program finished without any exception. Save session')
-		saveSessionOutput()
+		saveSessionOutput(True)
+		closeFrontier()
 	except:
 		#keyboard interrupt
 		saveSessionOutput()
+		closeFrontier()